@@ -0,0 +1,183 @@
+import math
+import time
+
+import coordination
+
+# Keeps track of the jobs waiting in each generate queue and of how long recent jobs took to run, so that waiting users
+# can be told their position in the queue and roughly how long they will wait, and so that new jobs can be turned away
+# when a queue is already too long.
+
+KEY_PREFIX = 'hay_say:admission:'
+DEFAULT_MAX_QUEUED_JOBS = 50  # per queue
+STALE_JOB_TIMEOUT = 3600  # seconds. Jobs that were never reported as started or finished are forgotten after this.
+SERVICE_TIME_SMOOTHING = 0.2  # Weight of the newest job in the moving average of service times.
+# Jobs are ordered in the queue the way celery consumes them: by priority, then by the time they were queued.
+PRIORITY_WEIGHT = 1e10
+
+_max_queued_jobs = DEFAULT_MAX_QUEUED_JOBS
+
+
+def configure(max_queued_jobs=None):
+    global _max_queued_jobs
+    _max_queued_jobs = max_queued_jobs if max_queued_jobs is not None else _max_queued_jobs
+
+
+def queued_key(queue):
+    return KEY_PREFIX + 'queued:' + queue
+
+
+def running_key(queue):
+    return KEY_PREFIX + 'running:' + queue
+
+
+def job_key(job_id):
+    return KEY_PREFIX + 'job:' + job_id
+
+
+def cache_key_key(cache_key):
+    return KEY_PREFIX + 'cache_key:' + cache_key
+
+
+def enqueue(queue, job_id, priority, cache_key, predicted_seconds=None):
+    """Add the job to the queue and return True, or return False without adding it if the queue is already full.
+    cache_key is the key that Dash uses to look up the job's progress and result. predicted_seconds is the cost model's
+    prediction of how long the job will take to run, if there is one."""
+    client = coordination.redis_client()
+    forget_stale_jobs(queue)
+    now = time.time()
+    pipeline = client.pipeline()
+    pipeline.zadd(queued_key(queue), {job_id: priority * PRIORITY_WEIGHT + now})
+    pipeline.hset(job_key(job_id), mapping={'Queue': queue, 'Queued': now, 'Score': priority * PRIORITY_WEIGHT + now,
+                                            **({} if predicted_seconds is None else
+                                               {'Predicted Seconds': predicted_seconds})})
+    pipeline.expire(job_key(job_id), STALE_JOB_TIMEOUT)
+    pipeline.set(cache_key_key(cache_key), job_id, ex=STALE_JOB_TIMEOUT)
+    pipeline.zcard(queued_key(queue))
+    if pipeline.execute()[-1] > _max_queued_jobs:
+        finish(job_id)
+        return False
+    return True
+
+
+def start(job_id):
+    # Called by the worker when it starts running the job.
+    client = coordination.redis_client()
+    queue = client.hget(job_key(job_id), 'Queue')
+    if queue is None:
+        return
+    now = time.time()
+    pipeline = client.pipeline()
+    pipeline.zrem(queued_key(queue), job_id)
+    pipeline.zadd(running_key(queue), {job_id: now})
+    pipeline.hset(job_key(job_id), 'Started', now)
+    pipeline.execute()
+
+
+def requeue(job_id):
+    # Called by the worker when it puts the job back in its queue without running it (see architecture_slots.py). The
+    # job keeps its original place in the queue.
+    client = coordination.redis_client()
+    job = client.hgetall(job_key(job_id))
+    if not job or 'Score' not in job:
+        return
+    pipeline = client.pipeline()
+    pipeline.zrem(running_key(job['Queue']), job_id)
+    pipeline.zadd(queued_key(job['Queue']), {job_id: float(job['Score'])})
+    pipeline.hdel(job_key(job_id), 'Started')
+    pipeline.execute()
+
+
+def finish(job_id):
+    # Called by the worker when it is done with the job, whether the job succeeded, failed or was revoked. It is safe to
+    # call this more than once for the same job.
+    client = coordination.redis_client()
+    job = client.hgetall(job_key(job_id))
+    if not job:
+        return
+    pipeline = client.pipeline()
+    pipeline.zrem(queued_key(job['Queue']), job_id)
+    pipeline.zrem(running_key(job['Queue']), job_id)
+    pipeline.delete(job_key(job_id))
+    pipeline.execute()
+    if 'Started' in job:
+        record_service_time(job['Queue'], time.time() - float(job['Started']))
+
+
+def record_service_time(queue, seconds):
+    client = coordination.redis_client()
+    average = client.hget(KEY_PREFIX + 'service_time', queue)
+    average = seconds if average is None else \
+        SERVICE_TIME_SMOOTHING * seconds + (1 - SERVICE_TIME_SMOOTHING) * float(average)
+    client.hset(KEY_PREFIX + 'service_time', queue, average)
+
+
+def average_service_time(queue):
+    # Return the moving average of the run times of the queue's jobs, or None if no job has run yet.
+    average = coordination.redis_client().hget(KEY_PREFIX + 'service_time', queue)
+    return None if average is None else float(average)
+
+
+def is_short_job(queue, predicted_seconds):
+    # A job is short if it is predicted to take less time than the average job in its queue. Jobs without a prediction
+    # are treated as short, so that they are not held back.
+    if predicted_seconds is None:
+        return True
+    average = average_service_time(queue)
+    return average is None or predicted_seconds <= average
+
+
+def is_full(queue):
+    forget_stale_jobs(queue)
+    return coordination.redis_client().zcard(queued_key(queue)) >= _max_queued_jobs
+
+
+def backlog_seconds(queue):
+    """Return the estimated number of seconds until all the jobs that are currently waiting in the queue have started,
+    or None if there isn't enough history to make an estimate."""
+    return estimate_seconds(queue, coordination.redis_client().zrange(queued_key(queue), 0, -1))
+
+
+def estimate_seconds(queue, job_ids):
+    # Add up the predicted run times of the given jobs, falling back to the average run time of the queue's jobs for any
+    # job that has no prediction, and divide by the number of jobs running at once, which is a stand-in for the number
+    # of workers serving the queue.
+    client = coordination.redis_client()
+    pipeline = client.pipeline()
+    for job_id in job_ids:
+        pipeline.hget(job_key(job_id), 'Predicted Seconds')
+    pipeline.zcard(running_key(queue))
+    *predictions, jobs_running = pipeline.execute()
+    average = average_service_time(queue)
+    if average is None and None in predictions:
+        return None
+    return sum(average if prediction is None else float(prediction) for prediction in predictions) / \
+        max(jobs_running, 1)
+
+
+def describe_wait(cache_key):
+    """Return a message for the user describing the job's position in its queue and the estimated time until it starts,
+    or None if the job is not waiting in a queue (e.g. because it is already running)."""
+    client = coordination.redis_client()
+    job_id = client.get(cache_key_key(cache_key))
+    queue = None if job_id is None else client.hget(job_key(job_id), 'Queue')
+    if queue is None:
+        return None
+    rank = client.zrank(queued_key(queue), job_id)
+    if rank is None:
+        return None
+    position = rank + 1
+    # Estimate the time needed to run this job and the jobs ahead of it.
+    seconds = estimate_seconds(queue, client.zrange(queued_key(queue), 0, rank))
+    if seconds is None:
+        return f'Waiting in queue: position {position}'
+    return f'Waiting in queue: position {position}, ~{math.ceil(seconds)} s'
+
+
+def forget_stale_jobs(queue):
+    client = coordination.redis_client()
+    cutoff = time.time() - STALE_JOB_TIMEOUT
+    client.zremrangebyscore(running_key(queue), '-inf', cutoff)
+    stale_jobs = [job_id for job_id, score in client.zrange(queued_key(queue), 0, -1, withscores=True)
+                  if score % PRIORITY_WEIGHT < cutoff]
+    if stale_jobs:
+        client.zrem(queued_key(queue), *stale_jobs)
@@ -0,0 +1,78 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Every request to an architecture server (<tab.id>_server:<tab.port>) goes through this module. Each server gets one
+# requests.Session with its own pool of keep-alive connections, so repeated requests reuse an open TCP connection
+# instead of setting up a new one, and every request has a timeout so a hung server cannot hold a worker forever.
+
+DEFAULT_CONNECT_TIMEOUT = 5  # seconds
+DEFAULT_READ_TIMEOUT = 900  # seconds. Generating long audio on a CPU can legitimately take several minutes.
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4  # per architecture server, per process
+
+_connect_timeout = DEFAULT_CONNECT_TIMEOUT
+_read_timeout = DEFAULT_READ_TIMEOUT
+_max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS
+
+_sessions = {}
+_semaphores = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def configure(connect_timeout=None, read_timeout=None, max_concurrent_requests=None):
+    # Override the default timeouts and concurrency limit. This must be called before the first request is made, since
+    # the connection pools and semaphores are sized when they are created.
+    global _connect_timeout, _read_timeout, _max_concurrent_requests
+    _connect_timeout = connect_timeout if connect_timeout is not None else _connect_timeout
+    _read_timeout = read_timeout if read_timeout is not None else _read_timeout
+    _max_concurrent_requests = max_concurrent_requests if max_concurrent_requests is not None \
+        else _max_concurrent_requests
+
+
+def server_host(tab):
+    # The hostname of the container running the given architecture.
+    return tab.id + '_server'
+
+
+def get(tab, path, read_timeout=None, bypass_limit=False):
+    return request(tab, 'GET', path, read_timeout=read_timeout, bypass_limit=bypass_limit)
+
+
+def post(tab, path, payload, read_timeout=None, bypass_limit=False):
+    return request(tab, 'POST', path, read_timeout=read_timeout, bypass_limit=bypass_limit, json=payload)
+
+
+def request(tab, method, path, read_timeout=None, bypass_limit=False, **kwargs):
+    # Send a request to the given architecture's server and return the requests.Response. At most
+    # _max_concurrent_requests requests are sent to the same server at a time; any others wait for a free slot.
+    # bypass_limit=True sends the request right away regardless. Use it for short requests that must not wait behind
+    # the ones they are about (e.g. /cancel, which is sent while this process's generate requests hold every slot).
+    session, semaphore = get_session_and_semaphore(server_host(tab), tab.port)
+    url = 'http://' + server_host(tab) + ':' + str(tab.port) + path
+    timeout = (_connect_timeout, read_timeout if read_timeout is not None else _read_timeout)
+    if bypass_limit:
+        return session.request(method, url, timeout=timeout, **kwargs)
+    with semaphore:
+        return session.request(method, url, timeout=timeout, **kwargs)
+
+
+def get_session_and_semaphore(host, port):
+    global _pid
+    key = (host, port)
+    with _lock:
+        if _pid != os.getpid():
+            # This process was forked from the one that opened the connections. Don't share sockets with the parent.
+            _sessions.clear()
+            _semaphores.clear()
+            _pid = os.getpid()
+        if key not in _sessions:
+            session = requests.Session()
+            # One extra connection is kept for requests that bypass the limit.
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_max_concurrent_requests + 1)
+            session.mount('http://', adapter)
+            _sessions[key] = session
+            _semaphores[key] = threading.BoundedSemaphore(_max_concurrent_requests)
+        return _sessions[key], _semaphores[key]
@@ -0,0 +1,99 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+
+import coordination
+
+# Most architecture servers work on one request at a time, so a pool of celery workers that all pick up jobs for the
+# same architecture just ends up with most of them blocked on that server while jobs for other architectures wait. Each
+# architecture can therefore be given a number of slots, shared by every worker through Redis. A job takes one of its
+# architecture's slots before it starts and gives it back when it is done. If they are all taken, the job goes back into
+# its queue to be retried shortly (see job_manager.py), and the worker moves on to a job for another architecture.
+#
+# Every worker must be given the same number of slots for an architecture.
+
+KEY_PREFIX = 'hay_say:architecture_slots:'
+SLOT_TIMEOUT = 3600  # seconds. A slot held by a worker that died is given back after this.
+RETRY_DELAY = 2  # seconds. How long a job that found no free slot waits before it is picked up again.
+
+# Takes a slot if one is free, after giving back any slots whose holders have timed out. Doing this in a script ensures
+# that two workers cannot take the last free slot at the same time.
+ACQUIRE_SLOT_SCRIPT = '''
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+return 1
+'''
+
+_slots = {}  # The number of slots of each architecture, by tab ID. Architectures not listed have unlimited slots.
+
+
+def configure(slots=None):
+    global _slots
+    _slots = slots if slots is not None else _slots
+
+
+def parse_slots(values):
+    # Parse values of the form '<architecture>=<number of slots>' into a dictionary.
+    slots = {}
+    for value in values:
+        architecture, _, count = value.partition('=')
+        if not count.strip().isdigit() or int(count) < 1:
+            raise Exception('Expected <architecture>=<number of slots>, with at least 1 slot, but got: ' + value)
+        slots[architecture.strip()] = int(count)
+    return slots
+
+
+@contextmanager
+def slot(architecture_id):
+    """Take one of the architecture's slots for the duration of the with block and yield True, or yield False without
+    taking one if they are all taken."""
+    limit = _slots.get(architecture_id)
+    client = coordination.redis_client()
+    key = KEY_PREFIX + architecture_id
+    token = uuid.uuid4().hex
+    try:
+        now = time.time()
+        acquired = limit is None or client.eval(ACQUIRE_SLOT_SCRIPT, 1, key, now, limit, now + SLOT_TIMEOUT, token)
+    except redis.exceptions.ConnectionError:
+        # The slots are there to use the workers well. Don't hold up every job just because Redis is unavailable.
+        limit, acquired = None, True
+    try:
+        yield bool(acquired)
+    finally:
+        if limit is not None and acquired:
+            client.zrem(key, token)
+
+
+@contextmanager
+def idle_slots(architecture_id, max_count):
+    """Take up to max_count more of the architecture's slots, but only ones that are free right now, and yield the
+    number taken. They are given back when the with block exits. A job that sends several requests to its architecture
+    server at once (see chunked_generation.py) takes one for each request beyond the first."""
+    limit = _slots.get(architecture_id)
+    client = coordination.redis_client()
+    key = KEY_PREFIX + architecture_id
+    tokens = []
+    try:
+        if limit is None:
+            count = max_count
+        else:
+            while len(tokens) < max_count:
+                token = uuid.uuid4().hex
+                now = time.time()
+                if not client.eval(ACQUIRE_SLOT_SCRIPT, 1, key, now, limit, now + SLOT_TIMEOUT, token):
+                    break
+                tokens.append(token)
+            count = len(tokens)
+    except redis.exceptions.ConnectionError:
+        # As in slot(), don't hold up the job just because Redis is unavailable.
+        count = max_count
+    try:
+        yield count
+    finally:
+        if tokens:
+            client.zrem(key, *tokens)
@@ -3,15 +3,17 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 from abc import ABC, abstractmethod
 
 import dash_bootstrap_components as dbc
 import hay_say_common as hsc
-import requests
 from dash import html, dcc, Input, Output, State, callback
 from dash.exceptions import PreventUpdate
 
+import architecture_client
 import download.Downloader as Downloader
+import model_warmup
 import util
 
 SHOW_CHARACTER_DOWNLOAD_MENU = '▷ Show Character Download Menu'
@@ -24,9 +26,13 @@ BASE_JSON_URL = 'https://raw.githubusercontent.com/hydrusbeta/hay_say_ui/' + BRA
 BASE_CHARACTER_JSON_URL = BASE_JSON_URL + CHARACTER_JSON_FILENAME
 BASE_MULTISPEAKER_JSON_URL = BASE_JSON_URL + MULTI_SPEAKER_JSON_FILENAME
 
+GPU_INFO_TTL = 60  # seconds
+
 
 class AbstractTab(ABC):
     _cache = None
+    _gpu_info = None
+    _gpu_info_time = 0
 
     def __init__(self, cache):
         self.cache = cache
@@ -117,6 +123,57 @@ class AbstractTab(ABC):
         # *args will be a list of values the same length of input_ids, in the respective order.
         return dict()
 
+    @property
+    def reproducible(self):
+        # Return True if the architecture always produces the same output when given the same inputs and options. Hay Say
+        # reuses previously generated output for reproducible requests instead of asking the container to generate it
+        # again. Leave this False for architectures whose output varies from run to run.
+        return False
+
+    @property
+    def seed_option(self):
+        # If the architecture accepts a random seed, return the key under which construct_input_dict stores it.
+        # Requests that specify a seed are treated as reproducible even if the architecture is not reproducible
+        # otherwise. Return None if the architecture does not accept a seed. Architectures that accept one should add
+        # construct_seed_row to their options.
+        return None
+
+    def construct_seed_row(self, input_id):
+        # An optional Seed field for the options of an architecture that accepts a random seed (see seed_option).
+        return html.Tr([
+            html.Td(html.Label('Seed', htmlFor=input_id), className='option-label'),
+            html.Td(dcc.Input(id=input_id, type='number', min=0, step=1, placeholder='Random'))
+        ], title='Leave this empty to get a different result every time. With a seed, the same text and options always '
+                 'give the same result, so Hay Say reuses the earlier output instead of generating it again.')
+
+    @staticmethod
+    def parse_seed(value):
+        # The Seed field is None while it is empty.
+        return None if value is None else int(value)
+
+    @property
+    def cost_features(self):
+        # Keys of numeric options (in the output of construct_input_dict) that affect how long generation takes, e.g. a
+        # number of diffusion steps. They are used to predict how long a request will take (see cost_model.py).
+        return []
+
+    def supports_text_chunking(self, input_dict):
+        # Return True if the request described by input_dict can be generated one chunk of sentences at a time, with the
+        # generated chunks simply joined together afterward (see chunked_generation.py). That is only the case if the
+        # architecture generates each sentence independently of the others.
+        return False
+
+    def supports_audio_chunking(self, input_dict):
+        # Return True if the request described by input_dict can be generated by converting the input audio one piece at
+        # a time, with the converted pieces joined together afterward (see chunked_generation.py). That is the case for
+        # architectures that convert audio to audio without regard to any text.
+        return False
+
+    def is_reproducible(self, input_dict):
+        # Return True if the request described by input_dict (the output of construct_input_dict) will produce the same
+        # output every time it is made.
+        return self.reproducible or (self.seed_option is not None and input_dict.get(self.seed_option) is not None)
+
     def downloadable_character_options(self, disabled=False):
         # Sorted options for a dcc.Checklist that includes all downloadable characters, minus the ones that are already
         # downloaded. Optionally set disabled=True to disable every option in the checklist.
@@ -135,31 +192,37 @@ class AbstractTab(ABC):
 
     @property
     def hardware_options(self):
-        return [*((['GPU']) if self.is_gpu_available else ()), 'CPU']
+        return [*((['Auto', 'GPU']) if self.is_gpu_available else ()), 'CPU']
 
     @property
     def is_gpu_available(self):
-        # todo: If there are multiple GPUs on the system, this method will return True if pytorch can see *any* of them.
-        #  However, it is possible that one of the invisible CUDA GPUs is selected by the the celery worker (the celery
-        #  worker doesn't know which architectures support which GPUs). We need to somehow make sure that that never
-        #  happens. Is there some way to communicate to celery that a particular job should only be picked up by
-        #  particular workers? Alternatively, maybe we can add a supported_gpus argument containing the GPU IDs of all
-        #  supported GPUs to the generate() method and have the celery worker check whether the GPU it is assigned to is
-        #  listed in supported_gpus. If it is not, then have it place the job back on the queue (if that is something
-        #  celery can do). A third option would be to refactor GPU management so that each celery worker is not just
-        #  assigned a single GPU at the start but can use any GPU and places a "lock" on the one it wants to use. Then
-        #  it just makes sure to select from among the GPUs listed in supported_gpus.
-        response = requests.get(f'http://{self.id + "_server"}:{self.port}/gpu-info')
+        return len(self.supported_gpus) > 0
+
+    @property
+    def supported_gpus(self):
+        # A list of the GPUs that are visible to the architecture, as reported by its container. Each GPU is described by
+        # a dictionary with the keys 'Index', 'Name', 'Free Memory' and 'Total Memory'. The GPU celery workers lease one
+        # of these GPUs for each job (see gpu_leases.py), so a job is never sent to a GPU the architecture cannot see.
+        # The list is remembered for GPU_INFO_TTL seconds because the set of GPUs practically never changes and this
+        # property is consulted on every lease and every page render. The memory figures in it may therefore be stale;
+        # call fetch_gpu_info() when current values are needed.
+        now = time.monotonic()
+        if self._gpu_info is None or now - self._gpu_info_time > GPU_INFO_TTL:
+            self._gpu_info = self.fetch_gpu_info()
+            self._gpu_info_time = now
+        return self._gpu_info
+
+    def fetch_gpu_info(self):
+        response = architecture_client.get(self, '/gpu-info')
         code = response.status_code
 
         if code != 200:
             # Something probably went wrong, so log a message and assume that GPU is not available.
-            print(f'Warning! is_gpu_available returned the unexpected http code {code}. Assuming GPU is not available. '
+            print(f'Warning! supported_gpus received the unexpected http code {code}. Assuming GPU is not available. '
                   f'Please inform the maintainers of Hay Say.')
-            return False
+            return []
         else:
-            gpu_info = response.json()
-            return len(gpu_info) > 0
+            return response.json()
 
     def tab_contents(self, enable_model_management):
         return html.Tr([
@@ -192,7 +255,7 @@ class AbstractTab(ABC):
                         ], className='centered')
                     ], is_open=False, id=self.id + "-download-menu", className='model-list-expanded'),
                 ], className='model-list-div')]) +
-                [self.options])
+                [self.options, dcc.Store(id=self.id + '-preload-hint')])
         ], id=self.id, hidden=True)
 
     @property
@@ -215,6 +278,21 @@ class AbstractTab(ABC):
     def register_callbacks(self, enable_model_management):
         if enable_model_management:
             self.register_model_management_callbacks()
+        self.register_preload_callback()
+
+    def register_preload_callback(self):
+        @callback(
+            Output(self.id + '-preload-hint', 'data'),
+            Input(self.input_ids[0], 'value'),
+            Input(self.id, 'hidden'),
+            prevent_initial_call=True
+        )
+        def preload_character(character, hidden):
+            # Have the architecture server start loading the character's model while the user is still filling in the
+            # other inputs (see model_warmup.py). Opening the tab counts as selecting the character that is shown.
+            if hidden or not model_warmup.hint(self, character):
+                raise PreventUpdate
+            return character
 
     def register_model_management_callbacks(self):
         @callback(
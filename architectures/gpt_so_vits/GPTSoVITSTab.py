@@ -3,7 +3,7 @@ from dash import html, dcc, Input, Output, State, callback, ctx
 from dash.exceptions import PreventUpdate
 from hay_say_common.cache import Stage
 
-import requests
+import architecture_client
 import model_licenses
 from architectures.AbstractTab import AbstractTab
 
@@ -135,11 +135,12 @@ class GPTSoVITSTab(AbstractTab):
                     html.Td(dcc.Input(id=self.input_ids[10], type='range', min=0.01, max=5.00, step=0.01, value=1.00)),
                     html.Td(dcc.Input(id=self.id + '-speed-number', type='number', min=0.01, max=5.00, step=0.01, value=1.00))
                 ])
-            ], title='Modifies the speed of the generated audio, without affecting pitch. Higher number = faster.')
+            ], title='Modifies the speed of the generated audio, without affecting pitch. Higher number = faster.'),
+            self.construct_seed_row(self.input_ids[13]),
         ], className='spaced-table')
 
     def available_precomputed_traits(self, character):
-        response = requests.get(f'http://{self.id + "_server"}:{self.port}/available-traits/{character}')
+        response = architecture_client.get(self, f'/available-traits/{character}')
         code = response.status_code
 
         if code != 200:
@@ -302,9 +303,18 @@ class GPTSoVITSTab(AbstractTab):
                 self.id+'-temperature',
                 self.id+'-speed',
                 self.id+'-trait',
-                self.id+'-reference-option'
+                self.id+'-reference-option',
+                self.id+'-seed'
                 ]
 
+    @property
+    def seed_option(self):
+        return 'Seed'
+
+    def supports_text_chunking(self, input_dict):
+        # The server slices the text and generates each slice independently unless told not to.
+        return input_dict.get('Cutting Strategy') != 'No slicing'
+
     def construct_input_dict(self, session_data, *args):
 
         input_dict = {
@@ -323,7 +333,8 @@ class GPTSoVITSTab(AbstractTab):
             'Temperature': float(args[9]),
             'Speed': float(args[10]),
             'Trait': args[11],
-            'Reference Option': args[12]
+            'Reference Option': args[12],
+            'Seed': self.parse_seed(args[13])
         }
         input_dict = {k: v for k, v in input_dict.items() if v is not None}  # Removes all entries whose values are None
         return input_dict
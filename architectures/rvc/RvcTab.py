@@ -208,6 +208,13 @@ class RvcTab(AbstractTab):
                 self.id+'-voiceless-consonants-protection-ratio',
                 ]
 
+    @property
+    def reproducible(self):
+        return True
+
+    def supports_audio_chunking(self, input_dict):
+        return True
+
     def construct_input_dict(self, session_data, *args):
         input_dict = {
             'Architecture': self.id,
@@ -204,6 +204,13 @@ class SoVitsSvc4Tab(AbstractTab):
                 self.id+'-reduce-noise'
                 ]
 
+    @property
+    def cost_features(self):
+        return ['Slice Length']
+
+    def supports_audio_chunking(self, input_dict):
+        return True
+
     def construct_input_dict(self, session_data, *args):
         return {
             'Architecture': self.id,
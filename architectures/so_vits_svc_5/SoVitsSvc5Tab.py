@@ -60,6 +60,9 @@ class SoVitsSvc5Tab(AbstractTab):
     def input_ids(self):
         return [self.id+'-character', self.id+'-semitone-pitch']
 
+    def supports_audio_chunking(self, input_dict):
+        return True
+
     def construct_input_dict(self, session_data, *args):
         return {
             'Architecture': self.id,
@@ -168,6 +168,7 @@ class StyleTTS2Tab(AbstractTab):
                     html.Td(dcc.Input(id=self.id + '-speed-number', type='number', min=0.1, max=5.0, step=0.01, value=1.0)),
                 ])
             ], title='Modifies the speed of the generated audio, without affecting pitch. Higher number = faster.'),
+            self.construct_seed_row(self.input_ids[12]),
         ], className='spaced-table')
 
     def styles_json(self):
@@ -366,8 +367,23 @@ class StyleTTS2Tab(AbstractTab):
                 self.id+'-precomputed-style-character',
                 self.id+'-precomputed-style-trait',
                 self.id+'-speed',
+                self.id+'-seed',
                 ]
 
+    @property
+    def seed_option(self):
+        return 'Seed'
+
+    @property
+    def cost_features(self):
+        return ['Diffusion Steps']
+
+    def supports_text_chunking(self, input_dict):
+        # With "Split Into Sentences" enabled, the server generates one sentence at a time anyway. A nonzero Style Blend
+        # carries the style of each sentence over into the next one, though, so the sentences must then be generated in
+        # order within a single request.
+        return input_dict['Use Long Form'] and input_dict['Style Blend'] == 0
+
     def construct_input_dict(self, session_data, *args):
         input_dict = {
             'Architecture': self.id,
@@ -386,6 +402,10 @@ class StyleTTS2Tab(AbstractTab):
             'Precomputed Style Trait': args[10],
             'Speed': float(args[11]),
         }
+        # Only send a seed if the user entered one, so that the server picks a random one otherwise.
+        seed = self.parse_seed(args[12])
+        if seed is not None:
+            input_dict['Seed'] = seed
         return input_dict
 
     def update_style_lists_for_styletts2(self):
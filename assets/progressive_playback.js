@@ -0,0 +1,49 @@
+// Plays a long output chunk by chunk while it is still being generated (see chunked_generation.py). The generate
+// callbacks report the part of the output that is ready so far through the partial-output-playlist store, as
+// {'Output File': <hash of the output>, 'Chunks': <URLs of the chunks at the start of the output that are ready, in
+// order>}. Each time a chunk finishes playing, the next one is played if it is ready; otherwise, it is played as soon as
+// it is reported.
+
+function playNextChunk(player) {
+    if (player.nextChunkIndex < player.chunks.length) {
+        player.waitingForChunk = false;
+        player.src = player.chunks[player.nextChunkIndex];
+        player.nextChunkIndex += 1;
+        player.play().catch(() => {});  // The browser may refuse to autoplay. The user can still press play.
+    } else {
+        player.waitingForChunk = true;
+    }
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    progressive_playback: {
+        play_ready_chunks: function (partialOutput) {
+            const player = document.getElementById('partial-output-player');
+            if (!player) {
+                return window.dash_clientside.no_update;
+            }
+            if (!partialOutput) {
+                // Nothing is ready yet. Hide the player unless it is still playing an earlier output.
+                if (player.paused) {
+                    player.hidden = true;
+                }
+                return window.dash_clientside.no_update;
+            }
+            if (!player.hasChunkListener) {
+                player.addEventListener('ended', () => playNextChunk(player));
+                player.hasChunkListener = true;
+            }
+            player.chunks = partialOutput['Chunks'];
+            if (player.outputFile !== partialOutput['Output File']) {
+                // This is a new output.
+                player.outputFile = partialOutput['Output File'];
+                player.nextChunkIndex = 0;
+                player.hidden = false;
+                playNextChunk(player);
+            } else if (player.waitingForChunk) {
+                playNextChunk(player);
+            }
+            return window.dash_clientside.no_update;
+        }
+    }
+});
@@ -0,0 +1,55 @@
+import io
+import os
+import re
+from urllib.parse import urlencode
+
+import flask
+from hay_say_common.cache import Stage
+
+import hay_say_common as hsc
+import chunk_store
+import plotly_celery_common as pcc
+import util
+
+AUDIO_ROUTE = '/audio/<stage_name>/<filename_sans_extension>.flac'
+AUDIO_MIMETYPE = 'audio/flac'
+HASH_PATTERN = re.compile(r'[0-9a-f]{20}')
+# A session ID, or the ID of a session's chunk store (see chunk_store.py).
+SESSION_PATTERN = re.compile(r'[0-9a-f]{32}|([0-9a-f]{32}-)?' + re.escape(chunk_store.STORE_NAME))
+
+
+def construct_audio_url(stage, session_id, filename_sans_extension):
+    # Build the URL that the audio route serves a cached file from. Use this as the src attribute of html.Audio instead
+    # of embedding the whole file as a base64 data URI.
+    url = '/audio/' + stage.name.lower() + '/' + filename_sans_extension + '.flac'
+    return url + ('?' + urlencode({'session': session_id}) if session_id else '')
+
+
+def register_audio_route(server, cache_type):
+    cache = hsc.select_cache_implementation(cache_type)
+
+    @server.route(AUDIO_ROUTE)
+    def stream_cached_audio(stage_name, filename_sans_extension):
+        # Serve a file from the audio cache. send_file answers Range requests with 206 Partial Content and answers
+        # If-None-Match/If-Modified-Since with 304 Not Modified, so the browser only fetches what it actually plays.
+        stage = util.get_enum_by_string(Stage, stage_name.upper())
+        session_id = flask.request.args.get('session')
+        if stage is None or not HASH_PATTERN.fullmatch(filename_sans_extension) \
+                or (session_id is not None and not SESSION_PATTERN.fullmatch(session_id)):
+            flask.abort(404)
+        return send_cached_file(cache, stage, session_id, filename_sans_extension)
+
+
+def send_cached_file(cache, stage, session_id, filename_sans_extension):
+    path = pcc.cache_file_path(cache, stage, session_id, filename_sans_extension)
+    if path is not None:
+        if not os.path.isfile(path):
+            flask.abort(404)
+        # ETag and Last-Modified are derived from the file itself.
+        return flask.send_file(path, mimetype=AUDIO_MIMETYPE, conditional=True)
+    if not cache.file_is_already_cached(stage, session_id, filename_sans_extension):
+        flask.abort(404)
+    # Cache files are content-addressed, so the hash is a valid ETag when there is no file to stat.
+    file_bytes = cache.read_file_bytes(stage, session_id, filename_sans_extension)
+    return flask.send_file(io.BytesIO(file_bytes), mimetype=AUDIO_MIMETYPE, conditional=True,
+                           etag=filename_sans_extension)
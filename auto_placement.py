@@ -0,0 +1,168 @@
+import redis
+from dash import Input, Output, State, callback
+from dash.long_callback.managers import BaseLongCallbackManager
+
+import admission
+import plotly_celery_common as pcc
+from generator import generation_progress
+
+# The "Auto" hardware option sends each job to whichever of the GPU and CPU queues is predicted to finish it first, so
+# that a backed-up GPU queue spills over onto idle CPU workers and vice versa. The predicted finish of a job on a queue is
+# the time needed to work through the jobs already waiting in the queue (see admission.py) plus the predicted run time
+# of the job itself (see cost_model.py). A queue that is full is never chosen while the other one has room.
+
+PREFERRED_HARDWARE = 'GPU'  # Used when there isn't enough history to predict which queue will finish the job first.
+
+
+class AutoPlacementManager(BaseLongCallbackManager):
+    """A background callback manager that doesn't run jobs itself. Instead, it hands each job to the background callback
+    manager of the chosen hardware, to be run by that hardware's generate function (which must take the same arguments
+    and return the same outputs as the callback that uses this manager). Job IDs are prefixed with the hardware so that
+    later calls about a job go to the manager that has it."""
+
+    def __init__(self):
+        self.placements = {}
+        self.functions = {}
+        super().__init__(None)
+
+    def place(self, hardware, manager, function):
+        # manager is a job_manager.GenerateJobManager and function is the background callback it runs on that hardware.
+        function_key = next(key for key, registered_function, _ in BaseLongCallbackManager.functions
+                            if registered_function is function)
+        self.placements[hardware] = (manager, function_key)
+        self.functions[hardware] = function
+
+    def make_job_fn(self, fn, progress, key=None):
+        # Jobs run through the placed functions, so there is nothing to register.
+        return None
+
+    def call_job_fn(self, key, job_fn, args, context):
+        hardware = self.choose_hardware(args)
+        manager, function_key = self.placements[hardware]
+        job = manager.call_job_fn(key, manager.func_registry[function_key], args, context)
+        return hardware + ':' + job
+
+    def run_placed_function(self, set_progress, args):
+        # Run the job right here, with the generate function of the hardware that would have been chosen for it.
+        return self.functions[self.choose_hardware(args)](set_progress, *args)
+
+    def choose_hardware(self, args):
+        try:
+            candidates = {hardware: manager for hardware, (manager, _) in self.placements.items()
+                          if not admission.is_full(manager.admission_queue(args))}
+            if len(candidates) <= 1:
+                # If every queue is full, let the preferred hardware's manager turn the job away.
+                return next(iter(candidates), PREFERRED_HARDWARE)
+            predictions = {hardware: manager.predict_run_time(args) for hardware, manager in candidates.items()}
+            finish_times = {hardware: self.predict_finish(hardware, manager, args, predictions)
+                            for hardware, manager in candidates.items()}
+        except redis.exceptions.ConnectionError:
+            return PREFERRED_HARDWARE
+        if None in finish_times.values():
+            return PREFERRED_HARDWARE
+        return min(finish_times, key=finish_times.get)
+
+    def predict_finish(self, hardware, manager, args, predictions):
+        # Return the predicted number of seconds until the job would be finished if it were sent to the given hardware,
+        # or None if there isn't enough history to say.
+        backlog_seconds = admission.backlog_seconds(manager.admission_queue(args))
+        run_seconds = predictions[hardware]
+        if run_seconds is None:
+            run_seconds = self.scale_other_prediction(hardware, args, predictions)
+        if run_seconds is None:
+            run_seconds = admission.average_service_time(manager.admission_queue(args))
+        return None if backlog_seconds is None or run_seconds is None else backlog_seconds + run_seconds
+
+    def scale_other_prediction(self, hardware, args, predictions):
+        # Without a prediction for this hardware, scale another hardware's prediction by how much faster or slower this
+        # hardware has been for the same architecture, judging by the average run times of the two queues.
+        average = admission.average_service_time(self.placements[hardware][0].admission_queue(args))
+        for other_hardware, prediction in predictions.items():
+            other_average = admission.average_service_time(self.placements[other_hardware][0].admission_queue(args))
+            if other_hardware != hardware and prediction is not None and average is not None and other_average:
+                return prediction * average / other_average
+        return None
+
+    def placed_job(self, job):
+        # Split a job ID returned by call_job_fn into the manager that has the job and that manager's job ID.
+        hardware, _, manager_job = job.partition(':')
+        return self.placements[hardware][0], manager_job
+
+    def terminate_job(self, job):
+        if job:
+            manager, manager_job = self.placed_job(job)
+            manager.terminate_job(manager_job)
+
+    def terminate_unhealthy_job(self, job):
+        if not job:
+            return False
+        manager, manager_job = self.placed_job(job)
+        return manager.terminate_unhealthy_job(manager_job)
+
+    def job_running(self, job):
+        if not job:
+            return False
+        manager, manager_job = self.placed_job(job)
+        return manager.job_running(manager_job)
+
+    def get_result(self, key, job):
+        manager, manager_job = self.placed_job(job)
+        return manager.get_result(key, manager_job)
+
+    # Dash only passes the cache key to the following methods, so ask every manager.
+
+    def get_progress(self, key):
+        return next((progress for progress in (manager.get_progress(key) for manager, _ in self.placements.values())
+                     if progress is not None), None)
+
+    def result_ready(self, key):
+        return any(manager.result_ready(key) for manager, _ in self.placements.values())
+
+    def clear_cache_entry(self, key):
+        for manager, _ in self.placements.values():
+            manager.clear_cache_entry(key)
+
+
+def register_auto_callback(architectures, gpu_step, cpu_step):
+    """Register the callback behind the "Auto" hardware option. gpu_step and cpu_step are the CacheSelection steps of
+    celery_generate_gpu and celery_generate_cpu. This callback must have the same arguments and outputs as theirs,
+    because its jobs are run by their generate functions."""
+    selected_architectures = pcc.select_architecture_tabs(architectures)
+    background_callback_manager = AutoPlacementManager()
+    background_callback_manager.place('GPU', gpu_step.background_callback_manager, gpu_step.generate_function)
+    background_callback_manager.place('CPU', cpu_step.background_callback_manager, cpu_step.generate_function)
+
+    @callback(
+        output=[Output('message', 'children', allow_duplicate=True),
+                Output('output-history-cursor', 'data', allow_duplicate=True),
+                Output('load-older-outputs', 'hidden', allow_duplicate=True),
+                Output('generate-button-auto', 'children')],  # To activate the spinner
+        inputs=[Input('generate-button-auto', 'n_clicks'),
+                State('session', 'data'),
+                State('text-input', 'value'),
+                State('file-dropdown', 'value'),
+                State('semitone-pitch', 'value'),
+                State('debug-pitch', 'value'),
+                State('reduce-noise', 'value'),
+                State('crop-silence', 'value'),
+                State('reduce-metallic-sound', 'value'),
+                State('auto-tune-output', 'value'),
+                State('adjust-output-speed', 'value')] +
+               [State(tab.id, 'hidden') for tab in selected_architectures] +
+               [State(item, 'value') for sublist in   # Add every architecture's inputs as States to the callback
+                [tab.input_ids for tab in selected_architectures]
+                for item in sublist],
+        running=[(Output('generate-message', 'hidden'), False, True),
+                 (Output('cancel-generate-button-auto', 'hidden'), False, True)],
+        cancel=[Input('cancel-generate-button-auto', 'n_clicks')],
+        progress=[Output('generate-message', 'children'),
+                  Output('partial-output-playlist', 'data')],
+        progress_default=generation_progress('Waiting in queue...'),
+        background=True,
+        manager=background_callback_manager,
+        prevent_initial_call=True
+    )
+    def generate_with_auto_placement(set_progress, *args):
+        # AutoPlacementManager normally hands the job to the chosen hardware's manager, whose worker runs that hardware's
+        # generate function, so this is only reached if the callback function is called directly.
+        return background_callback_manager.run_placed_function(set_progress, list(args))
@@ -0,0 +1,163 @@
+import json
+import time
+import traceback
+import uuid
+
+import redis
+
+import coordination
+
+# When several queued jobs are for the same architecture and character, sending each of them to the architecture server
+# on its own means the server sets up the same model and context once per job. Instead, the first job to arrive (the
+# "leader") opens a batch and waits a short window for compatible jobs (the "followers") to join it, possibly from other
+# worker processes or machines. The leader then sends every job in the batch to the server in a single /generate-batch
+# request, on its own GPU, and tells the followers when their output is ready. The server writes each job's output to
+# the OUTPUT stage of that job's session, exactly as /generate does, and each job writes its own metadata afterward.
+# Followers join a batch (see follow) before they take an architecture slot or lease a GPU, since the leader generates
+# their output with its own. Only the leader goes on to send anything (see send).
+#
+# If the server has no /generate-batch endpoint, or the batched request fails, every job falls back to sending its own
+# /generate request, so a batch never fails a job that would have succeeded on its own.
+
+KEY_PREFIX = 'hay_say:batching:'
+# Batching is off by default, since it only helps with architecture servers that have a /generate-batch endpoint.
+DEFAULT_MAX_BATCH_SIZE = 1
+DEFAULT_BATCH_WINDOW = 0.2  # seconds. The extra time the leader waits for compatible jobs before sending the batch.
+POLL_INTERVAL = 0.02  # seconds
+# Followers give up on a leader that hasn't reported back after this long (e.g. because its worker was killed) and send
+# their own requests. It needs to be longer than any batched request can take.
+FOLLOWER_TIMEOUT = 1800  # seconds
+RESULT_TIMEOUT = 60  # seconds. Followers only need a result for as long as it takes them to notice it.
+DONE = 'Done'
+FALLBACK = 'Fallback'
+
+# Adds a follower to a batch, but only if the batch is still open, and closes the batch once it is full. Doing this in a
+# script ensures that no follower can join a batch after the leader has read the list of followers.
+JOIN_BATCH_SCRIPT = '''
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local size = redis.call('rpush', KEYS[2], ARGV[2])
+redis.call('expire', KEYS[2], ARGV[4])
+if size + 1 >= tonumber(ARGV[3]) then
+    redis.call('del', KEYS[1])
+end
+return 1
+'''
+
+_max_batch_size = DEFAULT_MAX_BATCH_SIZE
+_batch_window = DEFAULT_BATCH_WINDOW
+_unsupported_architectures = set()  # Architectures whose servers turned out to have no /generate-batch endpoint.
+
+
+def configure(max_batch_size=None, batch_window=None):
+    global _max_batch_size, _batch_window
+    _max_batch_size = max_batch_size if max_batch_size is not None else _max_batch_size
+    _batch_window = batch_window if batch_window is not None else _batch_window
+
+
+def open_batch_key(tab_object, payload):
+    # Jobs can share a batch if they are for the same architecture and character and run on the same kind of hardware.
+    # The key holds the ID of the batch that compatible jobs can currently join, if there is one.
+    hardware = 'cpu' if payload['GPU ID'] == '' else 'gpu'
+    return KEY_PREFIX + 'open:' + tab_object.id + ':' + hardware + ':' + str(payload['Options'].get('Character'))
+
+
+def members_key(batch_id):
+    return KEY_PREFIX + 'members:' + batch_id
+
+
+def result_key(batch_id, payload):
+    return KEY_PREFIX + 'result:' + batch_id + ':' + payload['Output File']
+
+
+def follow(payload, tab_object):
+    """Join the open batch that the payload is compatible with, if there is one, and wait for its leader to send it.
+    Return True if the server generated the payload's output as part of the batch, or False if the payload still needs
+    to be sent (with send), because there was no open batch or the batched request failed."""
+    if _max_batch_size <= 1 or tab_object.id in _unsupported_architectures:
+        return False
+    client = coordination.redis_client()
+    open_key = open_batch_key(tab_object, payload)
+    try:
+        batch_id = client.get(open_key)
+        if batch_id is None or not client.eval(JOIN_BATCH_SCRIPT, 2, open_key, members_key(batch_id), batch_id,
+                                               json.dumps(payload), _max_batch_size, FOLLOWER_TIMEOUT):
+            return False
+        result = client.blpop(result_key(batch_id, payload), timeout=FOLLOWER_TIMEOUT)
+    except redis.exceptions.ConnectionError:
+        # Batching is an optimization. Don't fail the request just because Redis is unavailable.
+        return False
+    return result is not None and result[1] == DONE
+
+
+def send(payload, tab_object, send_one, send_batch):
+    """Have the architecture server generate the payload's output, either in a batch with the payloads of jobs that
+    join it while it is open or on its own. send_one(payload) sends a single payload with /generate.
+    send_batch(payloads) sends several payloads in one /generate-batch request and returns False if the server doesn't
+    support that. Both raise an Exception if the server fails to generate the output."""
+    if _max_batch_size <= 1 or tab_object.id in _unsupported_architectures:
+        return send_one(payload)
+    client = coordination.redis_client()
+    open_key = open_batch_key(tab_object, payload)
+    batch_id = uuid.uuid4().hex
+    try:
+        # The key expires at the end of the window, which closes the batch.
+        is_leader = client.set(open_key, batch_id, nx=True, px=max(int(_batch_window * 1000), 1))
+    except redis.exceptions.ConnectionError:
+        # Batching is an optimization. Don't fail the request just because Redis is unavailable.
+        return send_one(payload)
+    if not is_leader:
+        # This job took its slot and GPU while another job opened a batch. Don't hold them while waiting for it.
+        return send_one(payload)
+    lead_batch(client, open_key, batch_id, payload, tab_object, send_one, send_batch)
+
+
+def lead_batch(client, open_key, batch_id, payload, tab_object, send_one, send_batch):
+    followers = None
+    try:
+        while client.get(open_key) == batch_id:
+            time.sleep(POLL_INTERVAL)
+        followers = take_followers(client, batch_id)
+        # Every job in the batch is generated on the leader's GPU, with the leader's CPU threads.
+        if followers and send_batch([payload] + [{**follower, 'GPU ID': payload['GPU ID'],
+                                                  'CPU Threads': payload['CPU Threads']} for follower in followers]):
+            report(client, batch_id, followers, DONE)
+            return
+        if followers:
+            _unsupported_architectures.add(tab_object.id)
+    except Exception:
+        # The batched request failed. Let every job in the batch try again on its own.
+        traceback.print_exc()
+    except BaseException:
+        # The job is being cancelled. Let the followers generate their own output.
+        abandon_batch(client, open_key, batch_id, followers)
+        raise
+    abandon_batch(client, open_key, batch_id, followers)
+    send_one(payload)
+
+
+def take_followers(client, batch_id):
+    pipeline = client.pipeline()
+    pipeline.lrange(members_key(batch_id), 0, -1)
+    pipeline.delete(members_key(batch_id))
+    return [json.loads(follower) for follower in pipeline.execute()[0]]
+
+
+def abandon_batch(client, open_key, batch_id, followers):
+    # Tell the followers to send their own requests. followers is None if they haven't been taken off the batch yet.
+    try:
+        if followers is None:
+            coordination.release_lock(open_key, batch_id)  # Close the batch if it is still open.
+            followers = take_followers(client, batch_id)
+        report(client, batch_id, followers, FALLBACK)
+    except redis.exceptions.ConnectionError:
+        pass  # The followers will give up on the leader after FOLLOWER_TIMEOUT.
+
+
+def report(client, batch_id, followers, result):
+    pipeline = client.pipeline()
+    for follower in followers:
+        pipeline.rpush(result_key(batch_id, follower), result)
+        pipeline.expire(result_key(batch_id, follower), RESULT_TIMEOUT)
+    pipeline.execute()
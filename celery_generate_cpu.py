@@ -1,39 +1,57 @@
-import click
 import numpy
 from celery import Celery, bootsteps
 from click import Option
-from dash import Input, Output, State, callback, CeleryManager, ctx
+from dash import Input, Output, State, callback, ctx
 
-import hay_say_common as hsc
+import cpu_threads
+import generate_worker
 import main
 import plotly_celery_common as pcc
-from generator import generate_and_prepare_postprocessed_display
+from generator import generate_and_prepare_postprocessed_display, follow_identical_request, generation_progress
 
-# Set up a background callback manager
+# Set up the celery app. The background callback manager is created in CacheSelection, once the architectures are
+# known.
 REDIS_URL = 'redis://redis:6379/2'
 celery_app = Celery(__name__, broker=REDIS_URL, backend=REDIS_URL)
-background_callback_manager = CeleryManager(celery_app)
+generate_worker.configure_celery_app(celery_app)
 
-# Add a command-line argument for selecting the cache implementation
+# Add a command-line argument for sharing the CPU cores between the CPU jobs that run at the same time (see
+# cpu_threads.py)
 celery_app.user_options['worker'].add(
-    Option(('--cache_implementation',), default='file', show_default=True,
-           type=click.Choice(hsc.cache.cache_implementation_map.keys(), case_sensitive=False),
-           help='Selects an implementation for the audio cache, e.g. saving them to files or to a database.'))
-
-# Add a command-line argument that lets the user select specific architectures to register with the celery worker
-celery_app.user_options['worker'].add(
-    Option(('--include_architecture',), multiple=True, default=[], show_default=True,
-           help='Add an architecture for which the download callback will be registered'))
+    Option(('--cpu_thread_budget',), default=None, type=int,
+           help='Total number of threads that all the CPU jobs running at once on this host may use altogether. Each '
+                'job is given a share. By default, this is the number of physical CPU cores.'))
 
 
 # Add a boot step to use the command-line argument
 class CacheSelection(bootsteps.Step):
-    def __init__(self, parent, cache_implementation, include_architecture, **options):
+    def __init__(self, parent, cache_implementation, include_architecture, architecture_connect_timeout=None,
+                 architecture_read_timeout=None, architecture_max_concurrent_requests=None, serve_architecture=(),
+                 max_parallel_chunks=None, chunk_crossfade=None, max_batch_size=None, batch_window=None,
+                 model_memory_budget=None, architecture_slots=(), cpu_thread_budget=None, **options):
         super().__init__(parent, **options)
+        generate_worker.configure_modules(architecture_connect_timeout, architecture_read_timeout,
+                                          architecture_max_concurrent_requests, max_parallel_chunks, chunk_crossfade,
+                                          max_batch_size, batch_window, model_memory_budget)
+        cpu_threads.configure(cpu_thread_budget)
         selected_architectures = pcc.construct_architecture_tabs(include_architecture, cache_implementation)
 
+        def follow(callback_args):
+            return follow_identical_request(cache_implementation, '', selected_architectures, callback_args)
+
+        background_callback_manager = generate_worker.create_job_manager(celery_app, 'CPU', cache_implementation,
+                                                                         selected_architectures, follow=follow)
+        self.background_callback_manager = background_callback_manager
+
+        if parent is not None:  # i.e. this step is running in a celery worker rather than in the Dash server
+            parent.app.amqp.queues.select(generate_worker.served_queues(include_architecture, serve_architecture,
+                                                                        selected_architectures))
+            generate_worker.configure_architecture_slots(include_architecture, architecture_slots)
+
         @callback(
-            output=[Output('message', 'children'),
+            output=[Output('message', 'children', allow_duplicate=True),
+                    Output('output-history-cursor', 'data', allow_duplicate=True),
+                    Output('load-older-outputs', 'hidden', allow_duplicate=True),
                     Output('generate-button-cpu', 'children')],  # To activate the spinner
             inputs=[Input('generate-button-cpu', 'n_clicks'),
                     State('session', 'data'),
@@ -50,11 +68,15 @@ class CacheSelection(bootsteps.Step):
                    [State(item, 'value') for sublist in   # Add every architecture's inputs as States to the callback
                     [tab.input_ids for tab in selected_architectures]
                     for item in sublist],
-            running=[(Output('generate-message', 'hidden'), False, True)],
-            progress=Output('generate-message', 'children'),
-            progress_default='Waiting in queue...',
+            running=[(Output('generate-message', 'hidden'), False, True),
+                     (Output('cancel-generate-button-cpu', 'hidden'), False, True)],
+            cancel=[Input('cancel-generate-button-cpu', 'n_clicks')],
+            progress=[Output('generate-message', 'children'),
+                      Output('partial-output-playlist', 'data')],
+            progress_default=generation_progress('Waiting in queue...'),
             background=True,
             manager=background_callback_manager,
+            prevent_initial_call=True
         )
         def generate_with_cpu(set_progress, clicks, session_data, user_text, selected_file, semitone_pitch, debug_pitch,
                               reduce_noise, crop_silence, reduce_metallic_noise, auto_tune_output,
@@ -66,6 +88,8 @@ class CacheSelection(bootsteps.Step):
                                                               selected_file, semitone_pitch, debug_pitch, reduce_noise,
                                                               crop_silence, reduce_metallic_noise, auto_tune_output,
                                                               output_speed_adjustment, args)
+        # The "Auto" hardware option runs its jobs through this function (see auto_placement.py).
+        self.generate_function = generate_with_cpu
 
         @callback(
             [Output('hardware-selector', 'options')] +
@@ -1,38 +1,57 @@
-import click
-from billiard.process import current_process
 from celery import Celery, bootsteps
 from click import Option
-from dash import Input, Output, State, callback, CeleryManager
+from dash import Input, Output, State, callback
 
-import hay_say_common as hsc
+import generate_worker
+import pipeline_stages
 import plotly_celery_common as pcc
-from generator import generate_and_prepare_postprocessed_display
+from generator import generate_and_prepare_postprocessed_display, generation_progress, GenerateStages, LEASE_GPU
 
-# Set up a background callback manager
+# Set up the celery app. The background callback manager is created in CacheSelection, once the architectures are
+# known.
 REDIS_URL = 'redis://redis:6379/1'
 celery_app = Celery(__name__, broker=REDIS_URL, backend=REDIS_URL)
-background_callback_manager = CeleryManager(celery_app)
+generate_worker.configure_celery_app(celery_app)
 
-# Add a command-line argument for selecting the cache implementation
+# Add a command-line argument for running this worker in the pool that preprocesses and postprocesses GPU jobs when the
+# UI runs them as separate pipeline stages (see pipeline_stages.py)
 celery_app.user_options['worker'].add(
-    Option(('--cache_implementation',), default='file', show_default=True,
-           type=click.Choice(hsc.cache.cache_implementation_map.keys(), case_sensitive=False),
-           help='Selects an implementation for the audio cache, e.g. saving them to files or to a database.'))
+    Option(('--serve_pipeline_stages',), is_flag=True, default=False,
+           help='Pick up the preprocessing and postprocessing stages of GPU jobs instead of generating outputs. Use '
+                'this when the UI is started with --separate_pipeline_stages. These workers never wait on a GPU, so '
+                'they can be given a high concurrency.'))
 
-# Add a command-line argument that lets the user select specific architectures to register with the celery worker
-celery_app.user_options['worker'].add(
-    Option(('--include_architecture',), multiple=True, default=[], show_default=True,
-           help='Add an architecture for which the download callback will be registered'))
+# The message shown while a job generates its output. The GPU isn't known until the job leases one (see generator.py).
+GENERATING_MESSAGE = 'generating on GPU #{gpu_id}...'
 
 
 # Add a boot step to use the command-line argument
 class CacheSelection(bootsteps.Step):
-    def __init__(self, parent, cache_implementation, include_architecture, **options):
+    def __init__(self, parent, cache_implementation, include_architecture, architecture_connect_timeout=None,
+                 architecture_read_timeout=None, architecture_max_concurrent_requests=None, serve_architecture=(),
+                 max_parallel_chunks=None, chunk_crossfade=None, max_batch_size=None, batch_window=None,
+                 model_memory_budget=None, architecture_slots=(), serve_pipeline_stages=False, **options):
         super().__init__(parent, **options)
+        generate_worker.configure_modules(architecture_connect_timeout, architecture_read_timeout,
+                                          architecture_max_concurrent_requests, max_parallel_chunks, chunk_crossfade,
+                                          max_batch_size, batch_window, model_memory_budget)
         selected_architectures = pcc.construct_architecture_tabs(include_architecture, cache_implementation)
+        stages = GenerateStages(cache_implementation, LEASE_GPU, GENERATING_MESSAGE, selected_architectures)
+        background_callback_manager = generate_worker.create_job_manager(celery_app, 'GPU', cache_implementation,
+                                                                         selected_architectures, stages,
+                                                                         follow=stages.follow_identical_request)
+        self.background_callback_manager = background_callback_manager
+
+        if parent is not None:  # i.e. this step is running in a celery worker rather than in the Dash server
+            served_queues = generate_worker.served_queues(include_architecture, serve_architecture,
+                                                          selected_architectures)
+            parent.app.amqp.queues.select(pipeline_stages.STAGE_QUEUES if serve_pipeline_stages else served_queues)
+            generate_worker.configure_architecture_slots(include_architecture, architecture_slots)
 
         @callback(
             output=[Output('message', 'children', allow_duplicate=True),
+                    Output('output-history-cursor', 'data', allow_duplicate=True),
+                    Output('load-older-outputs', 'hidden', allow_duplicate=True),
                     Output('generate-button-gpu', 'children')],  # To activate the spinner
             inputs=[Input('generate-button-gpu', 'n_clicks'),
                     State('session', 'data'),
@@ -49,9 +68,12 @@ class CacheSelection(bootsteps.Step):
                    [State(item, 'value') for sublist in   # Add every architecture's inputs as States to the callback
                     [tab.input_ids for tab in selected_architectures]
                     for item in sublist],
-            running=[(Output('generate-message', 'hidden'), False, True)],
-            progress=Output('generate-message', 'children'),
-            progress_default='Waiting in queue...',
+            running=[(Output('generate-message', 'hidden'), False, True),
+                     (Output('cancel-generate-button-gpu', 'hidden'), False, True)],
+            cancel=[Input('cancel-generate-button-gpu', 'n_clicks')],
+            progress=[Output('generate-message', 'children'),
+                      Output('partial-output-playlist', 'data')],
+            progress_default=generation_progress('Waiting in queue...'),
             background=True,
             manager=background_callback_manager,
             prevent_initial_call=True
@@ -59,13 +81,15 @@ class CacheSelection(bootsteps.Step):
         def generate_with_gpu(set_progress, clicks, session_data, user_text, selected_file, semitone_pitch, debug_pitch,
                               reduce_noise, crop_silence, reduce_metallic_noise, auto_tune_output,
                               output_speed_adjustment, *args):
-            gpu_id = current_process().index
-            message = 'generating on GPU #' + str(gpu_id) + '...'
+            gpu_id = LEASE_GPU
+            message = GENERATING_MESSAGE
             return generate_and_prepare_postprocessed_display(clicks, set_progress, message, cache_implementation,
                                                               gpu_id, session_data, selected_architectures, user_text,
                                                               selected_file, semitone_pitch, debug_pitch, reduce_noise,
                                                               crop_silence, reduce_metallic_noise, auto_tune_output,
                                                               output_speed_adjustment, args)
+        # The "Auto" hardware option runs its jobs through this function (see auto_placement.py).
+        self.generate_function = generate_with_gpu
 
 
 celery_app.steps['worker'].add(CacheSelection)
@@ -0,0 +1,107 @@
+import os
+import shutil
+
+from hay_say_common.cache import Stage
+
+import plotly_celery_common as pcc
+
+# Each stage of the audio cache holds at most MAX_FILES_PER_STAGE files and evicts its oldest file whenever a new one
+# would go over that limit. The chunks that a job is generated in (see chunked_generation.py) therefore don't go into
+# the session's own stages, where a long job would evict the user's files (everyone's files, when session caches are
+# disabled) and could even evict its own chunks before they were stitched together. Instead, they go into a "chunk
+# store" next to the session's cache, which is addressed like a session of its own (<session>-chunks), so a chunk
+# request just carries the chunk store's ID as its Session ID and the architecture servers need no changes. The chunk
+# store's OUTPUT stage holds the generated chunks and its PREPROCESSED stage holds their inputs: the audio chunks cut
+# from the preprocessed input (see generator.split_preprocessed_audio), or a link to the session's preprocessed file.
+# Its RAW stage is a link to the session's own, for architectures that read reference audio from there.
+#
+# No metadata is ever written for the chunk store, so the cache doesn't count its files and never evicts them. Instead,
+# prune() deletes the least recently used files once a job has stitched its chunks together.
+# The chunk store needs a cache implementation that keeps its audio in files.
+
+STORE_NAME = 'chunks'
+STORED_STAGES = [Stage.PREPROCESSED, Stage.OUTPUT]
+LINKED_STAGES = [Stage.RAW]
+MAX_STORED_CHUNKS = 64  # per stage, per session
+
+
+def is_supported(cache):
+    return pcc.cache_file_path(cache, Stage.OUTPUT, None, STORE_NAME) is not None
+
+
+def store_id(session_id):
+    # The ID to address the given session's chunk store by, in place of a session ID.
+    return session_id + '-' + STORE_NAME if session_id else STORE_NAME
+
+
+def prepare(cache, session_id):
+    # Create the given session's chunk store if it doesn't exist yet, and return its ID.
+    chunk_store_id = store_id(session_id)
+    for stage in STORED_STAGES:
+        os.makedirs(cache.map_folder(stage, chunk_store_id), exist_ok=True)
+    for stage in LINKED_STAGES:
+        link = cache.map_folder(stage, chunk_store_id)
+        target = cache.map_folder(stage, session_id)
+        os.makedirs(target, exist_ok=True)
+        if not os.path.islink(link):
+            try:
+                # A relative link still works in the architecture containers, wherever they mount the audio cache.
+                os.symlink(os.path.relpath(target, os.path.dirname(link)), link, target_is_directory=True)
+            except FileExistsError:
+                pass  # Another job created it at the same moment.
+    return chunk_store_id
+
+
+def file_path(cache, session_id, stage, filename_sans_extension):
+    return pcc.cache_file_path(cache, stage, store_id(session_id), filename_sans_extension)
+
+
+def contains(cache, session_id, stage, filename_sans_extension):
+    return os.path.isfile(file_path(cache, session_id, stage, filename_sans_extension))
+
+
+def touch(cache, session_id, stage, filename_sans_extension):
+    # Mark a file as just used, so that prune() keeps it longer. Return False if the file isn't in the chunk store.
+    try:
+        os.utime(file_path(cache, session_id, stage, filename_sans_extension))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def save_input(cache, session_id, filename_sans_extension, array, samplerate):
+    # Unlike save_audio_to_cache, write_audio_file never evicts anything.
+    prepare(cache, session_id)
+    cache.write_audio_file(Stage.PREPROCESSED, store_id(session_id), filename_sans_extension, array, samplerate)
+
+
+def add_input(cache, session_id, hash_preprocessed):
+    # Make one of the session's preprocessed files available as a chunk input, without copying it if possible.
+    if touch(cache, session_id, Stage.PREPROCESSED, hash_preprocessed):
+        return
+    source = pcc.cache_file_path(cache, Stage.PREPROCESSED, session_id, hash_preprocessed)
+    destination = file_path(cache, session_id, Stage.PREPROCESSED, hash_preprocessed)
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass  # Another job added it at the same moment.
+    except OSError:
+        shutil.copyfile(source, destination)  # e.g. the file system doesn't support hard links.
+
+
+def prune(cache, session_id, keep):
+    # Delete the least recently used files in each stage of the given session's chunk store until at most
+    # MAX_STORED_CHUNKS are left in it, but never the files whose hashes are in keep.
+    for stage in STORED_STAGES:
+        stored = []
+        for entry in os.scandir(cache.map_folder(stage, store_id(session_id))):
+            try:
+                if os.path.splitext(entry.name)[0] not in keep:
+                    stored.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass  # Another job pruned it first.
+        for _, stored_path in sorted(stored, reverse=True)[max(MAX_STORED_CHUNKS - len(keep), 0):]:
+            try:
+                os.remove(stored_path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,168 @@
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import numpy
+
+import architecture_slots
+import gpu_leases
+import job_manager
+
+# Architecture servers that split long text into sentences (e.g. StyleTTS2's "Split Into Sentences" or GPT-SoVITS's
+# "Cutting Strategy") generate the sentences one after another within a single request. For architectures that allow it
+# (see AbstractTab.supports_text_chunking), the UI splits the text into chunks of whole sentences itself instead and
+# sends each chunk to the architecture server in its own request, several at a time and on as many GPUs as are free. The
+# generated chunks are then stitched back together with a short crossfade. A long passage then takes about as long as
+# its slowest chunk rather than as long as all of its chunks put together. The browser can also start playing the chunks
+# at the start of the text as soon as they are done, instead of waiting for the whole output, and when the text is
+# edited and generated again, only the chunks that changed are generated again.
+#
+# Architectures that convert audio to audio (see AbstractTab.supports_audio_chunking) are handled the same way, except
+# that it is the preprocessed input audio that is cut into chunks, at its quietest moments. Consecutive audio chunks
+# share a crossfade's worth of audio, so stitching the converted chunks back together restores the original timing.
+#
+# A job is never cut into more than MAX_CHUNKS_PER_JOB chunks. Longer inputs are cut into longer chunks instead. The
+# chunks themselves are kept out of the session's cache (see chunk_store.py).
+
+DEFAULT_MAX_PARALLEL_CHUNKS = 4  # per job
+DEFAULT_CROSSFADE_SECONDS = 0.05
+MAX_CHUNKS_PER_JOB = 16
+MIN_CHUNK_LENGTH = 40  # characters. Shorter sentences are combined with the next ones so each request is worthwhile.
+SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s+')
+MAX_AUDIO_CHUNK_SECONDS = 30
+MIN_AUDIO_CHUNK_SECONDS = 10  # Cuts are made at least this far apart so each request is worthwhile.
+SILENCE_FRAME_SECONDS = 0.02  # Cuts are placed in the middle of the quietest frame of this length.
+
+_max_parallel_chunks = DEFAULT_MAX_PARALLEL_CHUNKS
+_crossfade_seconds = DEFAULT_CROSSFADE_SECONDS
+
+
+def configure(max_parallel_chunks=None, crossfade_seconds=None):
+    global _max_parallel_chunks, _crossfade_seconds
+    _max_parallel_chunks = max_parallel_chunks if max_parallel_chunks is not None else _max_parallel_chunks
+    _crossfade_seconds = crossfade_seconds if crossfade_seconds is not None else _crossfade_seconds
+
+
+def is_enabled():
+    return _max_parallel_chunks > 1
+
+
+def split_text(user_text):
+    # Split the text into chunks of whole sentences, each at least MIN_CHUNK_LENGTH characters long (except possibly the
+    # last one, which is combined with the one before it if it is too short).
+    chunks = []
+    for sentence in SENTENCE_END.split((user_text or '').strip()):
+        if chunks and len(chunks[-1]) < MIN_CHUNK_LENGTH:
+            chunks[-1] += ' ' + sentence
+        else:
+            chunks.append(sentence)
+    if len(chunks) > 1 and len(chunks[-1]) < MIN_CHUNK_LENGTH:
+        chunks[-2] += ' ' + chunks.pop()
+    return limit_chunk_count(chunks, ' '.join)
+
+
+def limit_chunk_count(chunks, combine):
+    # Combine runs of consecutive chunks, as evenly as possible, so that there are no more than MAX_CHUNKS_PER_JOB.
+    # combine(list of chunks) returns the single chunk that they make up together.
+    if len(chunks) <= MAX_CHUNKS_PER_JOB:
+        return chunks
+    bounds = [len(chunks) * index // MAX_CHUNKS_PER_JOB for index in range(MAX_CHUNKS_PER_JOB + 1)]
+    return [combine(chunks[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+
+def normalize_text(chunk):
+    # Differences in whitespace don't change what is said, so they shouldn't keep a chunk's audio from being reused.
+    return ' '.join((chunk or '').split())
+
+
+def split_audio(data, samplerate, crossfade_seconds=None):
+    """Return a list of (start, end) sample ranges that cut the audio into chunks of at most MAX_AUDIO_CHUNK_SECONDS
+    each, at the quietest point between MIN_AUDIO_CHUNK_SECONDS and MAX_AUDIO_CHUNK_SECONDS after the previous cut. Each
+    chunk except the last runs on past its cut by the length of the crossfade that stitch() will apply. Audio too long
+    for MAX_CHUNKS_PER_JOB such chunks is cut into fewer, longer chunks."""
+    crossfade_seconds = _crossfade_seconds if crossfade_seconds is None else crossfade_seconds
+    overlap = int(crossfade_seconds * samplerate)
+    max_length = int(MAX_AUDIO_CHUNK_SECONDS * samplerate)
+    min_length = int(MIN_AUDIO_CHUNK_SECONDS * samplerate)
+    frame_length = max(int(SILENCE_FRAME_SECONDS * samplerate), 1)
+    loudness = numpy.abs(data) if data.ndim == 1 else numpy.abs(data).mean(axis=tuple(range(1, data.ndim)))
+    ranges = []
+    start = 0
+    while len(data) - start > max_length:
+        # Don't leave a chunk shorter than min_length at the end, either.
+        window_start, window_end = start + min_length, min(start + max_length, len(data) - min_length)
+        frame_count = (window_end - window_start) // frame_length
+        frames = loudness[window_start:window_start + frame_count * frame_length].reshape(frame_count, frame_length)
+        cut = window_start + int(numpy.argmin(frames.mean(axis=1))) * frame_length + frame_length // 2
+        ranges.append((start, min(cut + overlap, len(data))))
+        start = cut
+    ranges.append((start, len(data)))
+    # A combined range runs from the start of its first range to the end of its last, overlap included.
+    return limit_chunk_count(ranges, lambda combined: (combined[0][0], combined[-1][1]))
+
+
+@contextmanager
+def chunk_gpu_ids(tab_object, gpu_id, chunk_count):
+    """Yield a list of GPU IDs for generating chunk_count chunks, one chunk in flight per ID. gpu_id is the GPU that the
+    job is already using, or '' for the CPU. The job's own architecture slot covers one chunk in flight. Each further
+    chunk in flight needs another of the architecture's slots that happens to be free (see architecture_slots.py) and,
+    for a GPU job, another supported GPU that happens to be free (see gpu_leases.py). They are given back when the with
+    block exits."""
+    parallel_chunks = min(_max_parallel_chunks, chunk_count)
+    with architecture_slots.idle_slots(job_manager.queue_name(tab_object), parallel_chunks - 1) as extra_slots:
+        if gpu_id == '':
+            yield [''] * (1 + extra_slots)
+        else:
+            with gpu_leases.lease_idle_gpus(tab_object, extra_slots) as idle_gpu_ids:
+                yield [gpu_id] + idle_gpu_ids
+
+
+def send_concurrently(chunk_payloads, gpu_ids, send, cancel, on_finished=None):
+    """Call send(payload) for every payload, at most one per GPU ID at a time, with the payload's 'GPU ID' replaced by
+    the ID it is sent with. on_finished(payload) is called from the calling thread as each call returns. If any call
+    fails, or the job is interrupted (e.g. cancelled) while waiting, no more payloads are sent, cancel(payload) is called
+    for each one still being generated and the exception is re-raised."""
+    free_gpu_ids = queue.SimpleQueue()
+    for gpu_id in gpu_ids:
+        free_gpu_ids.put(gpu_id)
+
+    def send_chunk(payload):
+        gpu_id = free_gpu_ids.get()
+        try:
+            send({**payload, 'GPU ID': gpu_id})
+        finally:
+            free_gpu_ids.put(gpu_id)
+
+    # Don't use the executor as a context manager. On the way out of a with block it waits for the chunks that are still
+    # being generated, which would hold up a cancelled job until they were done.
+    executor = ThreadPoolExecutor(max_workers=len(gpu_ids))
+    futures = {executor.submit(send_chunk, payload): payload for payload in chunk_payloads}
+    try:
+        for future in as_completed(futures):
+            future.result()
+            if on_finished is not None:
+                on_finished(futures[future])
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future, payload in futures.items():
+            if future.running():
+                cancel(payload)
+        raise
+    executor.shutdown()
+
+
+def stitch(chunks, crossfade_seconds=None):
+    """Join a list of (data, samplerate) audio chunks into one (data, samplerate), overlapping consecutive chunks by a
+    linear crossfade."""
+    crossfade_seconds = _crossfade_seconds if crossfade_seconds is None else crossfade_seconds
+    samplerate = chunks[0][1]
+    if any(chunk_samplerate != samplerate for _, chunk_samplerate in chunks):
+        raise Exception('Cannot stitch together chunks that have different sample rates.')
+    stitched = chunks[0][0]
+    for data, _ in chunks[1:]:
+        overlap = min(int(crossfade_seconds * samplerate), len(stitched), len(data))
+        fade_in = numpy.linspace(0.0, 1.0, overlap, endpoint=False).reshape((overlap,) + (1,) * (data.ndim - 1))
+        crossfade = stitched[len(stitched) - overlap:] * (1.0 - fade_in) + data[:overlap] * fade_in
+        stitched = numpy.concatenate([stitched[:len(stitched) - overlap], crossfade, data[overlap:]])
+    return stitched, samplerate
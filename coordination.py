@@ -0,0 +1,34 @@
+import os
+
+import redis
+
+# Shared state that must be visible to every celery worker and to the Dash server (locks, counters, queues) is kept in
+# Redis. Databases 0-2 are used by the celery brokers, so coordination data gets a database of its own.
+REDIS_URL = 'redis://redis:6379/3'
+
+# Deletes a key only if it still holds the given token, so that a worker whose lock has already expired (and been taken
+# over by another worker) cannot release someone else's lock.
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+'''
+
+_client = None
+_pid = None
+
+
+def redis_client():
+    # Return a Redis client for the coordination database. A new client is created in each process, since gunicorn and
+    # celery fork their workers and a connection must not be shared with the parent process.
+    global _client, _pid
+    if _pid != os.getpid():
+        _client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        _pid = os.getpid()
+    return _client
+
+
+def release_lock(key, token):
+    return redis_client().eval(RELEASE_LOCK_SCRIPT, 1, key, token)
@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy
+import soundfile
+from hay_say_common.cache import Stage
+
+import coordination
+import plotly_celery_common as pcc
+
+# Predicts how long an architecture server will take to generate audio for a request. Every generation is recorded
+# together with its features (character, length of the text, duration of the input audio and any options that the
+# architecture lists in its cost_features property), and a ridge regression is fit to the most recent observations for
+# each combination of architecture and hardware (CPU or GPU). The predictions are used to estimate waiting times, to run
+# short jobs ahead of long ones and to choose between CPU and GPU.
+
+KEY_PREFIX = 'hay_say:cost_model:'
+MAX_OBSERVATIONS = 500  # per architecture and hardware. Older observations are discarded.
+MIN_OBSERVATIONS = 5  # Don't make predictions until there are at least this many observations.
+REFIT_INTERVAL = 10  # Refit the model after this many new observations.
+RIDGE_PENALTY = 0.1  # Keeps the fit stable when some features (e.g. rare characters) have few observations.
+
+
+def model_name(tab_object, on_gpu):
+    return tab_object.id + (':gpu' if on_gpu else ':cpu')
+
+
+def job_features(tab_object, options, user_text, input_audio_seconds):
+    # Return the features of a job as a dictionary of feature names and numeric values. options is the output of the
+    # tab's construct_input_dict. Categorical features (the character) are one-hot encoded.
+    text_length = len(user_text or '')
+    input_audio_seconds = input_audio_seconds or 0.0
+    features = {
+        'Intercept': 1.0,
+        'Text Length': float(text_length),
+        'Input Audio Seconds': float(input_audio_seconds),
+        'Character=' + str(options.get('Character')): 1.0,
+    }
+    # The cost of an option like "Diffusion Steps" tends to scale with the amount of audio being generated.
+    for name in tab_object.cost_features:
+        value = float(options.get(name) or 0.0)
+        features[name] = value
+        features[name + ' x Text Length'] = value * text_length
+        features[name + ' x Input Audio Seconds'] = value * input_audio_seconds
+    return features
+
+
+def input_audio_seconds(cache, session_id, hash_raw):
+    # Return the duration of a file at the RAW stage, or None if there is no such file.
+    if hash_raw is None:
+        return None
+    path = pcc.cache_file_path(cache, Stage.RAW, session_id, hash_raw)
+    if path is not None:
+        return soundfile.info(path).duration if os.path.isfile(path) else None
+    data, samplerate = cache.read_audio_from_cache(Stage.RAW, session_id, hash_raw)
+    return len(data) / samplerate
+
+
+def record(tab_object, on_gpu, features, seconds):
+    # Record how long a job took and occasionally refit the model.
+    client = coordination.redis_client()
+    observations_key = KEY_PREFIX + 'observations:' + model_name(tab_object, on_gpu)
+    pipeline = client.pipeline()
+    pipeline.lpush(observations_key, json.dumps({'Features': features, 'Seconds': seconds}))
+    pipeline.ltrim(observations_key, 0, MAX_OBSERVATIONS - 1)
+    pipeline.incr(KEY_PREFIX + 'new_observations:' + model_name(tab_object, on_gpu))
+    new_observations = pipeline.execute()[-1]
+    has_model = client.exists(KEY_PREFIX + 'coefficients:' + model_name(tab_object, on_gpu))
+    if new_observations >= REFIT_INTERVAL or (not has_model and new_observations >= MIN_OBSERVATIONS):
+        fit(tab_object, on_gpu)
+
+
+def fit(tab_object, on_gpu):
+    client = coordination.redis_client()
+    name = model_name(tab_object, on_gpu)
+    observations = [json.loads(observation) for observation in
+                    client.lrange(KEY_PREFIX + 'observations:' + name, 0, -1)]
+    client.set(KEY_PREFIX + 'new_observations:' + name, 0)
+    if len(observations) < MIN_OBSERVATIONS:
+        return
+    feature_names = sorted({feature for observation in observations for feature in observation['Features']})
+    x = numpy.array([[observation['Features'].get(feature, 0.0) for feature in feature_names]
+                     for observation in observations])
+    y = numpy.array([observation['Seconds'] for observation in observations])
+    # Scale the features so that a single penalty suits features of very different magnitudes, then solve the ridge
+    # regression (X'X + penalty*I) w = X'y.
+    scale = numpy.maximum(numpy.abs(x).max(axis=0), 1e-9)
+    x_scaled = x / scale
+    weights = numpy.linalg.solve(x_scaled.T @ x_scaled + RIDGE_PENALTY * numpy.eye(len(feature_names)),
+                                 x_scaled.T @ y) / scale
+    client.set(KEY_PREFIX + 'coefficients:' + name, json.dumps(dict(zip(feature_names, weights.tolist()))))
+
+
+def predict(tab_object, on_gpu, features):
+    """Return the predicted number of seconds that the architecture server will take to generate a job with the given
+    features, or None if there isn't enough history to make a prediction yet."""
+    coefficients = coordination.redis_client().get(KEY_PREFIX + 'coefficients:' + model_name(tab_object, on_gpu))
+    if coefficients is None:
+        return None
+    coefficients = json.loads(coefficients)
+    prediction = sum(coefficients.get(feature, 0.0) * value for feature, value in features.items())
+    return max(prediction, 0.0)
@@ -0,0 +1,100 @@
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+
+import coordination
+
+# PyTorch uses a thread for every core by default, so when several CPU jobs run at once, each architecture server tries
+# to use every core and they spend their time fighting over the cores instead of working. Instead, each CPU job is given
+# a share of the host's physical cores, which is sent to the architecture server in the payload as 'CPU Threads'. A job
+# gets an even share of the cores among the CPU jobs in flight, but never more than the cores that the jobs already in
+# flight have left over, so that the total stays within the number of cores. Jobs that start while the host is idle get
+# more threads than jobs that start while it is busy.
+
+KEY_PREFIX = 'hay_say:cpu_threads:'
+ALLOCATION_TIMEOUT = 3600  # seconds. Threads allocated to a worker that died are given back after this.
+
+# Allocates threads to a job and returns the number allocated, after giving back the threads of jobs whose allocations
+# have timed out. KEYS[1] is a sorted set of the jobs in flight, scored by when their allocations time out, and KEYS[2]
+# is a hash of the number of threads allocated to each of them.
+ALLOCATE_THREADS_SCRIPT = '''
+local expired = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1])
+for _, job in ipairs(expired) do
+    redis.call('zrem', KEYS[1], job)
+    redis.call('hdel', KEYS[2], job)
+end
+local reserved = 0
+for _, threads in ipairs(redis.call('hvals', KEYS[2])) do
+    reserved = reserved + tonumber(threads)
+end
+local total = tonumber(ARGV[2])
+local jobs = redis.call('zcard', KEYS[1]) + 1
+local threads = math.max(1, math.min(math.floor(total / jobs), total - reserved))
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+redis.call('hset', KEYS[2], ARGV[4], threads)
+return threads
+'''
+
+_total_threads = None
+
+
+def configure(total_threads=None):
+    global _total_threads
+    _total_threads = total_threads if total_threads is not None else _total_threads
+
+
+def physical_core_count():
+    # Hyperthreads don't speed up PyTorch much, so count each physical core once. /proc/cpuinfo lists a 'physical id'
+    # (the socket) and a 'core id' for each logical CPU.
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            cores, physical_id = set(), None
+            for line in cpuinfo:
+                name, _, value = line.partition(':')
+                if name.strip() == 'physical id':
+                    physical_id = value.strip()
+                elif name.strip() == 'core id':
+                    cores.add((physical_id, value.strip()))
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+    return os.cpu_count() or 1
+
+
+def total_threads():
+    return _total_threads if _total_threads is not None else physical_core_count()
+
+
+@contextmanager
+def allocate(gpu_id):
+    """Allocate threads to a job for the duration of the with block and yield the number allocated. Jobs on a GPU
+    (gpu_id != '') don't need many threads and are left to the architecture server's defaults, so None is yielded for
+    them."""
+    if gpu_id != '':
+        yield None
+        return
+    client = coordination.redis_client()
+    # The cores are shared by the workers and architecture servers on the same host.
+    jobs_key = KEY_PREFIX + 'jobs:' + socket.gethostname()
+    threads_key = KEY_PREFIX + 'threads:' + socket.gethostname()
+    token = uuid.uuid4().hex
+    try:
+        now = time.time()
+        threads = client.eval(ALLOCATE_THREADS_SCRIPT, 2, jobs_key, threads_key, now, total_threads(),
+                              now + ALLOCATION_TIMEOUT, token)
+    except redis.exceptions.ConnectionError:
+        # Without Redis, the number of jobs in flight is unknown. Leave it to the architecture server.
+        threads = None
+    try:
+        yield threads
+    finally:
+        if threads is not None:
+            pipeline = client.pipeline()
+            pipeline.zrem(jobs_key, token)
+            pipeline.hdel(threads_key, token)
+            pipeline.execute()
@@ -0,0 +1,78 @@
+import time
+
+import flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import coordination
+
+# Celery hands out jobs first-come, first-served, so one user who queues up many jobs would make everyone else wait for
+# all of them. Instead, each job is given a celery priority based on the number of jobs its requester already has in
+# flight: everyone's first job runs before anyone's second job, everyone's second job before anyone's third, and so on.
+# Among jobs of the same rank, jobs that are predicted to be short run first. Requesters are also limited to a maximum
+# number of jobs in flight.
+# A requester is a session, or a client IP address when session caches are disabled (all sessions then share one ID).
+# The client IP address is the address of whoever connected to the server, which is the reverse proxy if there is one.
+# Start Hay Say with --trusted_proxies to have it take the address from the X-Forwarded-For header instead (see
+# trust_proxies). The header is never trusted otherwise, since any client can put whatever it likes in it.
+
+KEY_PREFIX = 'hay_say:fair_share:'
+DEFAULT_MAX_JOBS_PER_SESSION = 5
+DEFAULT_TRUSTED_PROXIES = 0
+PRIORITY_LEVELS = 10  # Priorities run from 0 (served first) to PRIORITY_LEVELS - 1.
+STALE_JOB_TIMEOUT = 3600  # seconds. Jobs that were never reported as finished stop counting against the cap after this.
+
+# Celery's Redis transport only distinguishes between 4 priority levels by default.
+BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(PRIORITY_LEVELS))}
+
+_max_jobs_per_session = DEFAULT_MAX_JOBS_PER_SESSION
+
+
+def configure(max_jobs_per_session=None):
+    global _max_jobs_per_session
+    _max_jobs_per_session = max_jobs_per_session if max_jobs_per_session is not None else _max_jobs_per_session
+
+
+def requester_key(session_id):
+    # Must be called while handling a request from the requester.
+    return session_id if session_id else flask.request.remote_addr
+
+
+def trust_proxies(server, trusted_proxies):
+    # Have the server believe the last trusted_proxies entries of the X-Forwarded-For header, i.e. the ones that were
+    # added by the reverse proxies in front of Hay Say, so that request.remote_addr is the client's address.
+    if trusted_proxies > 0:
+        server.wsgi_app = ProxyFix(server.wsgi_app, x_for=trusted_proxies)
+
+
+def admit(requester, job_id):
+    """Count the job against the requester's jobs in flight and return the number of other jobs the requester has in
+    flight, or None if the requester already has the maximum number of jobs in flight, in which case the job is not
+    counted."""
+    client = coordination.redis_client()
+    in_flight_key = KEY_PREFIX + 'in_flight:' + requester
+    now = time.time()
+    pipeline = client.pipeline()
+    pipeline.zremrangebyscore(in_flight_key, '-inf', now - STALE_JOB_TIMEOUT)
+    pipeline.zadd(in_flight_key, {job_id: now})
+    pipeline.expire(in_flight_key, STALE_JOB_TIMEOUT)
+    pipeline.set(KEY_PREFIX + 'job:' + job_id, requester, ex=STALE_JOB_TIMEOUT)
+    pipeline.zcard(in_flight_key)
+    jobs_in_flight = pipeline.execute()[-1]
+    if jobs_in_flight > _max_jobs_per_session:
+        finish(job_id)
+        return None
+    return jobs_in_flight - 1
+
+
+def priority(rank, is_short_job):
+    # Return the celery priority for a job, given the number of other jobs its requester has in flight.
+    return min(2 * rank + (0 if is_short_job else 1), PRIORITY_LEVELS - 1)
+
+
+def finish(job_id):
+    # Stop counting the job against its requester. It is safe to call this more than once for the same job.
+    client = coordination.redis_client()
+    requester = client.get(KEY_PREFIX + 'job:' + job_id)
+    if requester is not None:
+        client.zrem(KEY_PREFIX + 'in_flight:' + requester, job_id)
+        client.delete(KEY_PREFIX + 'job:' + job_id)
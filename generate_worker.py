@@ -0,0 +1,159 @@
+import click
+from click import Option
+
+import architecture_client
+import architecture_slots
+import batching
+import chunked_generation
+import fair_share
+import hay_say_common as hsc
+import job_manager
+import model_residency
+import plotly_celery_common as pcc
+from generator import display_new_output, estimate_generation_time, generation_progress
+
+# The CPU and GPU generate workers (celery_generate_cpu.py and celery_generate_gpu.py) take the same command-line
+# arguments and manage their jobs the same way. This module sets up what they have in common.
+
+
+def configure_celery_app(celery_app):
+    # Apply the settings that the generate workers share and add their shared command-line arguments.
+    celery_app.conf.broker_transport_options = fair_share.BROKER_TRANSPORT_OPTIONS
+    # Only reserve one job at a time and acknowledge it once it is done. Otherwise, each worker process grabs several
+    # jobs ahead of time, which defeats the fair-share priorities (a prefetched job cannot be overtaken by a more
+    # deserving one) and loses the prefetched jobs if the worker dies.
+    celery_app.conf.worker_prefetch_multiplier = 1
+    celery_app.conf.task_acks_late = True
+    options = celery_app.user_options['worker']
+
+    # Add a command-line argument for selecting the cache implementation
+    options.add(
+        Option(('--cache_implementation',), default='file', show_default=True,
+               type=click.Choice(hsc.cache.cache_implementation_map.keys(), case_sensitive=False),
+               help='Selects an implementation for the audio cache, e.g. saving them to files or to a database.'))
+
+    # Add a command-line argument that lets the user select specific architectures to register with the celery worker
+    options.add(
+        Option(('--include_architecture',), multiple=True, default=[], show_default=True,
+               help='Add an architecture for which the download callback will be registered'))
+
+    # Add a command-line argument that lets the user select which architectures' jobs this worker picks up. Each
+    # architecture has its own queue, so running separate workers for different architectures keeps slow jobs for one
+    # architecture from holding up jobs for the others.
+    options.add(
+        Option(('--serve_architecture',), multiple=True, default=[], show_default=True,
+               help='Only pick up jobs for this architecture. Can be given multiple times. By default, the worker '
+                    'picks up jobs for every included architecture.'))
+
+    # Add a command-line argument for limiting how many jobs each architecture server works on at once, across all
+    # workers (see architecture_slots.py)
+    options.add(
+        Option(('--architecture_slots',), multiple=True, default=[], show_default=True,
+               help='Given as <architecture>=<number>, e.g. Rvc=1. At most this many jobs for the architecture run at '
+                    'once, across all workers. Other jobs for it wait in its queue, leaving the workers free for jobs '
+                    'for other architectures. Can be given multiple times. By default, there is no limit.'))
+
+    # Add command-line arguments for tuning the connections to the architecture servers
+    options.add(
+        Option(('--architecture_connect_timeout',), default=architecture_client.DEFAULT_CONNECT_TIMEOUT,
+               show_default=True, type=float,
+               help='Seconds to wait while connecting to an architecture server before giving up.'))
+    options.add(
+        Option(('--architecture_read_timeout',), default=architecture_client.DEFAULT_READ_TIMEOUT, show_default=True,
+               type=float, help='Seconds to wait for an architecture server to respond before giving up.'))
+    options.add(
+        Option(('--architecture_max_concurrent_requests',),
+               default=architecture_client.DEFAULT_MAX_CONCURRENT_REQUESTS, show_default=True, type=int,
+               help='Maximum number of simultaneous requests from each worker process to each architecture server.'))
+
+    # Add command-line arguments for generating long text and long input audio in chunks (see chunked_generation.py)
+    options.add(
+        Option(('--max_parallel_chunks',), default=chunked_generation.DEFAULT_MAX_PARALLEL_CHUNKS, show_default=True,
+               type=int, help='Maximum number of chunks of a long text or input recording that are generated at the '
+                              'same time. Set this to 1 to send the whole text or recording in a single request '
+                              'instead.'))
+    options.add(
+        Option(('--chunk_crossfade',), default=chunked_generation.DEFAULT_CROSSFADE_SECONDS, show_default=True,
+               type=float, help='Seconds of overlap between consecutive chunks of a long text or input recording when '
+                                'they are stitched together.'))
+
+    # Add command-line arguments for sending compatible jobs to the architecture servers in batches (see batching.py)
+    options.add(
+        Option(('--max_batch_size',), default=batching.DEFAULT_MAX_BATCH_SIZE, show_default=True, type=int,
+               help='Maximum number of jobs for the same architecture and character that are sent to the architecture '
+                    'server in a single /generate-batch request. The default of 1 sends every job on its own.'))
+    options.add(
+        Option(('--batch_window',), default=batching.DEFAULT_BATCH_WINDOW, show_default=True, type=float,
+               help='Seconds that a job waits for compatible jobs to join its batch before the batch is sent.'))
+
+    # Add a command-line argument for bounding the memory taken up by loaded models (see model_residency.py)
+    options.add(
+        Option(('--model_memory_budget',), default=model_residency.DEFAULT_MEMORY_BUDGET, type=float,
+               help='Gigabytes of models that the architecture servers may keep loaded. When the recently used models '
+                    'add up to more than this, the least recently used ones are unloaded. By default, models are never '
+                    'unloaded.'))
+
+
+def configure_modules(architecture_connect_timeout=None, architecture_read_timeout=None,
+                      architecture_max_concurrent_requests=None, max_parallel_chunks=None, chunk_crossfade=None,
+                      max_batch_size=None, batch_window=None, model_memory_budget=None):
+    # Apply the command-line arguments added by configure_celery_app.
+    architecture_client.configure(architecture_connect_timeout, architecture_read_timeout,
+                                  architecture_max_concurrent_requests)
+    chunked_generation.configure(max_parallel_chunks, chunk_crossfade)
+    batching.configure(max_batch_size, batch_window)
+    model_residency.configure(model_memory_budget)
+
+
+def configure_architecture_slots(include_architecture, architecture_slots_options):
+    slots = architecture_slots.parse_slots(architecture_slots_options)
+    unknown_architectures = set(slots).difference(include_architecture)
+    if unknown_architectures:
+        raise Exception('--architecture_slots must name included architectures, but these were not included: '
+                        + ', '.join(sorted(unknown_architectures)))
+    architecture_slots.configure({job_manager.queue_name(tab): slots[name] for name, tab in
+                                  zip(slots, pcc.select_architecture_tabs(slots))})
+
+
+def served_queues(include_architecture, serve_architecture, selected_architectures):
+    # Return the queues of the architectures whose jobs the worker picks up.
+    unknown_architectures = set(serve_architecture).difference(include_architecture)
+    if unknown_architectures:
+        raise Exception('--serve_architecture must name included architectures, but these were not included: '
+                        + ', '.join(sorted(unknown_architectures)))
+    served_architectures = pcc.select_architecture_tabs(serve_architecture) if serve_architecture \
+        else selected_architectures
+    return [job_manager.queue_name(tab) for tab in served_architectures]
+
+
+def create_job_manager(celery_app, hardware, cache_implementation, selected_architectures, stages=None, follow=None):
+    # Create the background callback manager of the generate callback for the given hardware ('CPU' or 'GPU'). See
+    # job_manager.GenerateJobManager for stages and follow.
+    all_input_ids = [item for sublist in [tab.input_ids for tab in selected_architectures] for item in sublist]
+
+    def architecture_args(callback_args):
+        # The hidden states of the tabs and the architectures' inputs come at the end of the callback's arguments.
+        # These are what the generate callback receives as *args.
+        return callback_args[len(callback_args) - len(all_input_ids) - len(selected_architectures):]
+
+    def select_queue(callback_args):
+        # Send the job to the queue of the selected architecture.
+        hidden_states = architecture_args(callback_args)[0:len(selected_architectures)]
+        selected_tab = {hidden: tab for hidden, tab in zip(hidden_states, selected_architectures)}.get(False)
+        return None if selected_tab is None else job_manager.queue_name(selected_tab)
+
+    def select_session_id(callback_args):
+        # The session data is the first State of the callback, right after the button's n_clicks.
+        return callback_args[1]['id']
+
+    def reject(callback_args, message):
+        return display_new_output(message)
+
+    def estimate_cost(callback_args):
+        # The session data, text and selected file are the first three States of the callback.
+        return estimate_generation_time(cache_implementation, callback_args[1], callback_args[2], callback_args[3],
+                                        selected_architectures, architecture_args(callback_args),
+                                        on_gpu=hardware == 'GPU')
+
+    return job_manager.GenerateJobManager(celery_app, hardware, select_queue, select_session_id, reject, estimate_cost,
+                                          generation_progress, stages, follow=follow)
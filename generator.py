@@ -1,15 +1,39 @@
 import base64
 import datetime
-import json
+import itertools
+import threading
+import time
 import traceback
 import uuid
-from http.client import HTTPConnection
+from contextlib import nullcontext
 
+import redis
+from dash import Patch, no_update
 from hay_say_common.cache import Stage
 
+import architecture_client
+import batching
+import chunk_store
+import chunked_generation
+import cost_model
+import cpu_threads
+import gpu_leases
 import hay_say_common as hsc
+import model_residency
+import output_index
 import plotly_celery_common as pcc
-from postprocessed_display import prepare_postprocessed_display
+import single_flight
+from audio_streaming import construct_audio_url
+from job_context import JobContext
+from postprocessed_display import prepare_postprocessed_display, prepare_output_history_page
+
+
+# Pass this as the gpu_id to generate on whichever supported GPU is free. See gpu_leases.py
+LEASE_GPU = None
+CANCEL_TIMEOUT = 5  # seconds
+
+# The output file of the job that the current worker thread is running, if follow_identical_request produced it.
+_followed_output = threading.local()
 
 
 # todo: That's a lot of inputs, and most of them get passed down to the generate() method. Is there a cleaner way to
@@ -18,44 +42,168 @@ def generate_and_prepare_postprocessed_display(clicks, set_progress, message, ca
                                                selected_architectures, user_text, selected_file, semitone_pitch,
                                                debug_pitch, reduce_noise, crop_silence, reduce_metallic_noise,
                                                auto_tune_output, output_speed_adjustment, args):
-    if clicks is not None:
-        highlight_first = True
-        try:
-            set_progress(message)
-            generate(cache_type, gpu_id, session_data, selected_architectures, user_text,
-                     selected_file, semitone_pitch, debug_pitch, reduce_noise, crop_silence,
-                     reduce_metallic_noise, auto_tune_output, output_speed_adjustment, args)
-        except Exception as e:
-            return 'An error has occurred. Please send the software maintainers the following information as ' \
-                   'well as any recent output in the Command Prompt/terminal (please review and remove any ' \
-                   'private info before sending!): \n\n' + \
-                   traceback.format_exc(), 'Generate!'
-    else:
-        highlight_first = False
-    cache = hsc.select_cache_implementation(cache_type)
-    sorted_hashes = cache.get_hashes_sorted_by_timestamp(Stage.POSTPROCESSED, session_data['id'])
-    first_output = [
-        prepare_postprocessed_display(cache, sorted_hashes[0], session_data,
-                                      highlight=highlight_first)] if sorted_hashes else []
-    remaining_outputs = [prepare_postprocessed_display(cache, hash_postprocessed, session_data)
-                         for hash_postprocessed in reversed(sorted_hashes[1:])]
-    return remaining_outputs + first_output, 'Generate!'
-
-
-def generate(cache_type, gpu_id, session_data, selected_architectures, user_text, selected_file, semitone_pitch,
-             debug_pitch, reduce_noise, crop_silence, reduce_metallic_noise, auto_tune_output, output_speed_adjustment,
-             args):
-    print('generating on ' + ('CPU' if gpu_id == '' else ('GPU #' + str(gpu_id))), flush=True)
-    cache = hsc.select_cache_implementation(cache_type)
-    selected_tab_object = get_selected_tab_object(selected_architectures, args[0:len(selected_architectures)])
-    relevant_inputs = get_inputs_for_selected_tab(selected_architectures, selected_tab_object,
-                                                  args[len(selected_architectures):])
+    # The three stages below can also be run as separate celery tasks. See GenerateStages. Here, they share a JobContext,
+    # so that each audio file and metadata entry is read from the cache at most once.
+    cache = JobContext(hsc.select_cache_implementation(cache_type))
+    try:
+        hash_preprocessed = preprocess_if_needed(cache, selected_file, semitone_pitch, debug_pitch, reduce_noise,
+                                                 crop_silence, session_data)
+        hash_output = generate_output_file(set_progress, message, cache, gpu_id, session_data, selected_architectures,
+                                           user_text, hash_preprocessed, args)
+        return postprocess_and_prepare_display(cache, session_data, hash_output, reduce_metallic_noise,
+                                               auto_tune_output, output_speed_adjustment)
+    except Exception:
+        return display_error()
+
+
+def generate_output_file(set_progress, message, cache, gpu_id, session_data, selected_architectures, user_text,
+                         hash_preprocessed, args):
+    # Have the architecture server generate the output, leasing a GPU for the duration if needed, and return its hash.
+    selected_tab_object, _, options = select_request(selected_architectures, session_data, args)
+    followed_output = getattr(_followed_output, 'output', None)
+    _followed_output.output = None
+    if followed_output is not None and followed_output[0] == flight_key(hash_preprocessed, user_text, options):
+        # The output was already produced, without leasing a GPU, by an identical request or a batch.
+        return followed_output[1]
+    with (gpu_leases.lease_gpu(selected_tab_object, lambda wait_message: set_progress(
+            generation_progress(wait_message))) if gpu_id is LEASE_GPU else nullcontext(gpu_id)) as gpu_id:
+        # message may contain a {gpu_id} placeholder, since the GPU isn't known until it has been leased.
+        message = message.format(gpu_id=gpu_id)
+        set_progress(generation_progress(message))
+        return generate(cache, gpu_id, session_data, selected_architectures, user_text, hash_preprocessed, args,
+                        lambda partial_output: set_progress(generation_progress(message, partial_output)))
+
+
+def follow_identical_request(cache_type, gpu_id, selected_architectures, callback_args):
+    """Called by the worker before it takes an architecture slot for a job (see job_manager.py). If an identical request
+    is already being generated (see single_flight.py), or the job can join an open batch (see batching.py), wait for
+    the other request or the batch here, so that the job doesn't hold a slot or a GPU while it waits. Return True if
+    the job's output file was produced that way, in which case generate_output_file doesn't generate it again.
+    callback_args are the arguments of a generate callback, excluding set_progress."""
+    _followed_output.output = None
+    cache = JobContext(hsc.select_cache_implementation(cache_type))
+    session_data, user_text, selected_file, semitone_pitch, debug_pitch, reduce_noise, crop_silence = callback_args[1:8]
+    tab_object, relevant_inputs, options = select_request(selected_architectures, session_data, callback_args[11:])
+    if tab_object is None:
+        return False
     hash_preprocessed = preprocess_if_needed(cache, selected_file, semitone_pitch, debug_pitch, reduce_noise,
                                              crop_silence, session_data)
-    hash_output = process(cache, user_text, hash_preprocessed, selected_tab_object, relevant_inputs,
-                          session_data, gpu_id)
-    hash_postprocessed = postprocess(cache, hash_output, reduce_metallic_noise, auto_tune_output,
-                                     output_speed_adjustment, session_data)
+    hash_output = compute_output_hash(tab_object, options, relevant_inputs, user_text, hash_preprocessed)
+    if tab_object.is_reproducible(options) and cache.file_is_already_cached(Stage.OUTPUT, session_data['id'],
+                                                                             hash_output):
+        return False  # process reuses it without contacting the architecture server.
+
+    followed = False
+    leader_output = single_flight.wait(flight_key(hash_preprocessed, user_text, options))
+    if leader_output is not None:
+        try:
+            adopt_output(cache, *leader_output, hash_output, session_data)
+            followed = True
+        except Exception:
+            pass  # The other request's output was evicted from its cache. The job generates it after all.
+    if not followed and len(split_inputs(cache, user_text, hash_preprocessed, tab_object, options, session_data)) == 1:
+        # The batch's leader generates the output on its own GPU, with its own CPU threads.
+        payload = construct_payload(user_text, hash_preprocessed, tab_object, relevant_inputs, hash_output,
+                                    session_data, gpu_id)
+        followed = batching.follow(payload, tab_object)
+        if followed:
+            verify_output_exists(cache, hash_output, session_data)
+    if followed:
+        write_output_metadata(cache, hash_preprocessed, user_text, hash_output, options, session_data)
+        _followed_output.output = (flight_key(hash_preprocessed, user_text, options), hash_output)
+    return followed
+
+
+def postprocess_and_prepare_display(cache, session_data, hash_output, reduce_metallic_noise, auto_tune_output,
+                                    output_speed_adjustment):
+    hash_postprocessed, is_new_output = postprocess(cache, hash_output, reduce_metallic_noise, auto_tune_output,
+                                                    output_speed_adjustment, session_data)
+    if not is_new_output:
+        # A reproducible request was repeated, so the output was reused and is already in the output history. Its
+        # timestamp was refreshed, so re-render the newest page of the history to move it to the bottom.
+        displays, oldest_timestamp, has_older_outputs = prepare_output_history_page(cache, session_data,
+                                                                                     highlight_newest=True)
+        return displays, oldest_timestamp, not has_older_outputs, 'Generate!'
+    metadata = pcc.read_metadata_entry(cache, Stage.POSTPROCESSED, session_data['id'], hash_postprocessed)
+    return display_new_output(prepare_postprocessed_display(cache, hash_postprocessed, session_data, highlight=True,
+                                                            metadata=metadata))
+
+
+def display_error():
+    # Call this from an except block.
+    return display_new_output('An error has occurred. Please send the software maintainers the following information '
+                              'as well as any recent output in the Command Prompt/terminal (please review and remove '
+                              'any private info before sending!): \n\n' + traceback.format_exc())
+
+
+class GenerateStages:
+    """The stages of generate_and_prepare_postprocessed_display, for running each of them as a separate celery task
+    (see job_manager.py). callback_args are the arguments of a generate callback, excluding set_progress. The stages run
+    in different processes, so each one gets a JobContext of its own."""
+
+    def __init__(self, cache_type, gpu_id, message, selected_architectures):
+        self.cache_type = cache_type
+        self.gpu_id = gpu_id
+        self.message = message
+        self.selected_architectures = selected_architectures
+
+    def preprocess(self, callback_args):
+        _, session_data, _, selected_file, semitone_pitch, debug_pitch, reduce_noise, crop_silence = callback_args[:8]
+        return preprocess_if_needed(self.job_context(), selected_file, semitone_pitch, debug_pitch, reduce_noise,
+                                    crop_silence, session_data)
+
+    def generate_output_file(self, set_progress, callback_args, hash_preprocessed):
+        session_data, user_text, args = callback_args[1], callback_args[2], callback_args[11:]
+        return generate_output_file(set_progress, self.message, self.job_context(), self.gpu_id, session_data,
+                                    self.selected_architectures, user_text, hash_preprocessed, args)
+
+    def postprocess(self, callback_args, hash_output):
+        session_data, (reduce_metallic_noise, auto_tune_output, output_speed_adjustment) = \
+            callback_args[1], callback_args[8:11]
+        return postprocess_and_prepare_display(self.job_context(), session_data, hash_output, reduce_metallic_noise,
+                                               auto_tune_output, output_speed_adjustment)
+
+    def job_context(self):
+        return JobContext(hsc.select_cache_implementation(self.cache_type))
+
+    def follow_identical_request(self, callback_args):
+        return follow_identical_request(self.cache_type, self.gpu_id, self.selected_architectures, callback_args)
+
+    def display_error(self):
+        # Call this from an except block.
+        return display_error()
+
+
+def generation_progress(message, partial_output=None):
+    # The progress of the generate callbacks: a message for the user, and the part of the output that is ready to be
+    # played while the rest is still being generated, if any (see generate_in_chunks and assets/progressive_playback.js).
+    return [message, partial_output]
+
+
+def display_new_output(new_output):
+    # Append the new output to the outputs that the browser is already displaying instead of re-rendering the whole
+    # history, so that the cost of a click stays the same no matter how many outputs the session has.
+    displayed_outputs = Patch()
+    displayed_outputs.append(new_output)
+    return displayed_outputs, no_update, no_update, 'Generate!'
+
+
+def generate(cache, gpu_id, session_data, selected_architectures, user_text, hash_preprocessed, args,
+             report_partial_output=None):
+    print('generating on ' + ('CPU' if gpu_id == '' else ('GPU #' + str(gpu_id))), flush=True)
+    selected_tab_object, relevant_inputs, _ = select_request(selected_architectures, session_data, args)
+    return process(cache, user_text, hash_preprocessed, selected_tab_object, relevant_inputs, session_data, gpu_id,
+                   report_partial_output)
+
+
+def select_request(selected_architectures, session_data, args):
+    # Return the selected tab, its inputs and the options that its construct_input_dict makes of them. args are the
+    # hidden states of the tabs followed by every tab's inputs.
+    tab_object = get_selected_tab_object(selected_architectures, args[0:len(selected_architectures)])
+    if tab_object is None:
+        return None, None, None
+    relevant_inputs = get_inputs_for_selected_tab(selected_architectures, tab_object, args[len(selected_architectures):])
+    return tab_object, relevant_inputs, tab_object.construct_input_dict(session_data, *relevant_inputs)
 
 
 def get_selected_tab_object(selected_architectures, hidden_states):
@@ -79,35 +227,82 @@ def preprocess_if_needed(cache, selected_file, semitone_pitch, debug_pitch, redu
     return hash_preprocessed
 
 
-def process(cache, user_text, hash_preprocessed, tab_object, relevant_inputs, session_data, gpu_id):
-    """Send a JSON payload to a container, instructing it to perform processing"""
+def process(cache, user_text, hash_preprocessed, tab_object, relevant_inputs, session_data, gpu_id,
+            report_partial_output=None):
+    """Send a JSON payload to a container, instructing it to perform processing. If the output is generated in chunks,
+    report_partial_output is called with the part of the output that is ready each time more of it is ready."""
+
+    options = tab_object.construct_input_dict(session_data, *relevant_inputs)
+    hash_output = compute_output_hash(tab_object, options, relevant_inputs, user_text, hash_preprocessed)
+    if tab_object.is_reproducible(options) and cache.file_is_already_cached(Stage.OUTPUT, session_data['id'],
+                                                                             hash_output):
+        # If this request has been made before, there is no need to contact the container at all.
+        return hash_output
+
+    def generate_output():
+        start_time = time.time()
+        model_residency.record_use(tab_object, options.get('Character'))
+        with cpu_threads.allocate(gpu_id) as threads:
+            payload = construct_payload(user_text, hash_preprocessed, tab_object, relevant_inputs, hash_output,
+                                        session_data, gpu_id, threads)
+            chunk_inputs = split_inputs(cache, user_text, hash_preprocessed, tab_object, options, session_data)
+            if len(chunk_inputs) > 1:
+                reused_chunk_count = generate_in_chunks(cache, payload, chunk_inputs, tab_object, session_data, gpu_id,
+                                                        report_partial_output)
+            else:
+                batching.send(payload, tab_object, lambda single_payload: send_payload(single_payload, tab_object),
+                              lambda batched_payloads: send_batched_payloads(batched_payloads, tab_object))
+                reused_chunk_count = 0
+        if reused_chunk_count == 0:
+            # Don't teach the cost model that long texts are quick to generate just because most of one was reused.
+            record_generation_time(cache, tab_object, options, user_text, hash_preprocessed, session_data, gpu_id,
+                                   time.time() - start_time)
+
+        # Uncomment this for local testing only. It writes a mock output file by copying the input file.
+        # data_preprocessed, sr_preprocessed = cache.read_audio_from_cache(Stage.PREPROCESSED, session_data['id'],
+        #                                                                  hash_preprocessed)
+        # cache.save_audio_to_cache(Stage.OUTPUT, session_data['id'], hash_output, data_preprocessed, sr_preprocessed)
+
+        verify_output_exists(cache, hash_output, session_data)
+        return session_data['id'], hash_output
+
+    # If an identical request is already being generated, possibly for another session, wait for it and reuse its
+    # output instead of generating the same thing twice. Usually, follow_identical_request has already waited for it
+    # before the job took a slot or leased a GPU. This catches identical requests that started at the same moment.
+    (leader_session_id, leader_hash_output), is_leader = single_flight.run(
+        flight_key(hash_preprocessed, user_text, options), generate_output)
+    if not is_leader:
+        try:
+            adopt_output(cache, leader_session_id, leader_hash_output, hash_output, session_data)
+        except Exception:
+            # The other request's output was evicted from its cache before it could be copied. Generate it after all.
+            generate_output()
 
-    # todo: A nonce is added to the arguments of compute_next_hash so that generating output multiple times using the
-    #  same input arguments will result in multiple outputs being displayed in the UI. Without it, architectures with
-    #  nondeterministic output can't display multiple outputs. However, this has the side effect of making the
-    #  postprocessing cache useless. It's kinda useless anyways at the moment since there are no postprocessing options
-    #  yet, but is there a better way to handle this?
-    nonce = uuid.uuid4().hex
-    hash_output = pcc.compute_next_hash(hash_preprocessed, user_text, relevant_inputs, nonce)
-    payload = construct_payload(user_text, hash_preprocessed, tab_object, relevant_inputs, hash_output,
-                                session_data, gpu_id)
+    write_output_metadata(cache, hash_preprocessed, user_text, hash_output, options, session_data)
+    return hash_output
 
-    host = tab_object.id + '_server'
-    port = tab_object.port
-    send_payload(payload, host, port)
 
-    # Uncomment this for local testing only. It writes a mock output file by copying the input file.
-    # data_preprocessed, sr_preprocessed = cache.read_audio_from_cache(Stage.PREPROCESSED, session_data['id'],
-    #                                                                  hash_preprocessed)
-    # cache.save_audio_to_cache(Stage.OUTPUT, session_data['id'], hash_output, data_preprocessed, sr_preprocessed)
+def compute_output_hash(tab_object, options, relevant_inputs, user_text, hash_preprocessed):
+    if tab_object.is_reproducible(options):
+        # The output depends only on the inputs and options, so the hash is a pure content key.
+        return pcc.compute_next_hash(hash_preprocessed, user_text, options)
+    # A nonce is added to the arguments of compute_next_hash so that generating output multiple times using the same
+    # input arguments will result in multiple outputs being displayed in the UI. Without it, architectures with
+    # nondeterministic output can't display multiple outputs. The downside is that the output can never be reused.
+    nonce = uuid.uuid4().hex
+    return pcc.compute_next_hash(hash_preprocessed, user_text, relevant_inputs, nonce)
 
-    verify_output_exists(cache, hash_output, session_data)
-    write_output_metadata(cache, hash_preprocessed, user_text, hash_output, tab_object, relevant_inputs, session_data)
-    return hash_output
+
+def flight_key(hash_preprocessed, user_text, options):
+    # Requests with the same architecture, options, text and input audio produce interchangeable outputs (see
+    # single_flight.py). The nonce is left out of this key on purpose.
+    return pcc.compute_next_hash(hash_preprocessed, user_text, options)
 
 
 def construct_payload(user_text, hash_preprocessed, tab_object, relevant_inputs, hash_output,
-                      session_data, gpu_id):
+                      session_data, gpu_id, threads=None):
+    # threads is the number of CPU threads that the architecture server may use for the request (see cpu_threads.py), or
+    # None to leave it up to the server.
     return {
         'Inputs': {
             'User Text': user_text,
@@ -116,16 +311,136 @@ def construct_payload(user_text, hash_preprocessed, tab_object, relevant_inputs,
         'Options': tab_object.construct_input_dict(session_data, *relevant_inputs),
         'Output File': hash_output,
         'GPU ID': gpu_id,
+        'CPU Threads': threads,
         'Session ID': session_data['id']
     }
 
 
-def send_payload(payload, host, port):
-    connection = HTTPConnection(host + ':' + str(port))
-    headers = {'Content-type': 'application/json'}
-    connection.request('POST', '/generate', json.dumps(payload), headers)
-    response = connection.getresponse()
-    code = response.status
+def split_inputs(cache, user_text, hash_preprocessed, tab_object, options, session_data):
+    # Return the Inputs of each of the chunks that the request should be generated in (see chunked_generation.py), or a
+    # list with just the request's own Inputs if it should be generated in one piece.
+    if not chunked_generation.is_enabled() or not chunk_store.is_supported(cache):
+        return [{'User Text': user_text, 'User Audio': hash_preprocessed}]
+    if tab_object.supports_text_chunking(options):
+        return [{'User Text': chunk, 'User Audio': hash_preprocessed}
+                for chunk in chunked_generation.split_text(user_text)]
+    if hash_preprocessed is not None and tab_object.supports_audio_chunking(options):
+        return [{'User Text': user_text, 'User Audio': hash_chunk}
+                for hash_chunk in split_preprocessed_audio(cache, hash_preprocessed, session_data)]
+    return [{'User Text': user_text, 'User Audio': hash_preprocessed}]
+
+
+def split_preprocessed_audio(cache, hash_preprocessed, session_data):
+    # Cut a long preprocessed file into chunks at its quietest moments and save each chunk to the PREPROCESSED stage of
+    # the session's chunk store (see chunk_store.py), so that the architecture servers can read them like any other
+    # input. Return the hashes of the chunks, or a list with just hash_preprocessed if the file is short enough to
+    # convert in one piece.
+    data_preprocessed, sr_preprocessed = cache.read_audio_from_cache(Stage.PREPROCESSED, session_data['id'],
+                                                                     hash_preprocessed)
+    ranges = chunked_generation.split_audio(data_preprocessed, sr_preprocessed)
+    if len(ranges) == 1:
+        return [hash_preprocessed]
+    hashes_chunks = []
+    for start, end in ranges:
+        hash_chunk = pcc.compute_next_hash(hash_preprocessed, 'chunk', start, end)
+        if not chunk_store.touch(cache, session_data['id'], Stage.PREPROCESSED, hash_chunk):
+            chunk_store.save_input(cache, session_data['id'], hash_chunk, data_preprocessed[start:end], sr_preprocessed)
+        hashes_chunks.append(hash_chunk)
+    return hashes_chunks
+
+
+def generate_in_chunks(cache, payload, chunk_inputs, tab_object, session_data, gpu_id, report_partial_output=None):
+    """Generate each chunk of the request in its own request, several at a time, and then stitch the chunks together
+    into the output file that the payload asks for (see chunked_generation.py). chunk_inputs holds the Inputs of each
+    chunk, in order. Return the number of chunks whose audio was reused instead of being generated again."""
+    # Each chunk's audio is kept in the session's chunk store (see chunk_store.py) under a hash of everything that
+    # determines it: the input audio, the options (which include the architecture, character and seed, if any) and the
+    # normalized text of the chunk. When the user edits a few sentences and generates again, only the chunks that
+    # changed are sent to the architecture server, and the audio of the others is spliced back in.
+    chunk_store_id = chunk_store.prepare(cache, session_data['id'])
+    # The chunks' input audio must be in the chunk store too. Audio chunks are already there (see
+    # split_preprocessed_audio). Otherwise, the chunks share the session's preprocessed file, if any.
+    hashes_inputs = {inputs['User Audio'] for inputs in chunk_inputs if inputs['User Audio'] is not None}
+    for hash_input in hashes_inputs:
+        chunk_store.add_input(cache, session_data['id'], hash_input)
+    chunk_payloads = [{**payload,
+                       'Inputs': inputs,
+                       'Output File': pcc.compute_next_hash(inputs['User Audio'], 'chunk',
+                                                            chunked_generation.normalize_text(inputs['User Text']),
+                                                            payload['Options']),
+                       'Session ID': chunk_store_id}
+                      for inputs in chunk_inputs]
+    # Touching the reused chunks keeps the session's other jobs from pruning them while this job needs them.
+    cached_chunks = {chunk_payload['Output File'] for chunk_payload in chunk_payloads
+                     if chunk_store.touch(cache, session_data['id'], Stage.OUTPUT, chunk_payload['Output File'])}
+    # The same chunk may appear more than once in the text. Only generate it once.
+    unique_chunk_payloads = list({chunk_payload['Output File']: chunk_payload
+                                  for chunk_payload in chunk_payloads}.values())
+    if len(cached_chunks) == len(unique_chunk_payloads) and not tab_object.is_reproducible(payload['Options']):
+        # Nothing was edited, so the user is asking for a new take of an architecture whose output varies from run to
+        # run. Generate every chunk again. The new take replaces the old one as the audio that later edits reuse.
+        cached_chunks = set()
+    uncached_chunk_payloads = [chunk_payload for chunk_payload in unique_chunk_payloads
+                               if chunk_payload['Output File'] not in cached_chunks]
+    finished_chunks = set(cached_chunks)
+    reported_chunks = []
+
+    def report_ready_chunks():
+        # Each chunk is written to the chunk store as soon as it is generated, so the browser can start playing the
+        # chunks at the start of the output while the later ones are still being generated.
+        ready_chunks = list(itertools.takewhile(lambda ready: ready['Output File'] in finished_chunks, chunk_payloads))
+        if report_partial_output is not None and len(ready_chunks) > len(reported_chunks):
+            reported_chunks[:] = ready_chunks
+            report_partial_output({
+                'Output File': payload['Output File'],
+                'Chunks': [construct_audio_url(Stage.OUTPUT, chunk_store_id, ready['Output File'])
+                           for ready in ready_chunks]
+            })
+
+    def report_finished_chunk(chunk_payload):
+        finished_chunks.add(chunk_payload['Output File'])
+        report_ready_chunks()
+
+    def generate_chunks(chunk_payloads_to_generate):
+        with chunked_generation.chunk_gpu_ids(tab_object, gpu_id, len(chunk_payloads_to_generate)) as gpu_ids:
+            # Chunks generated on the CPU at the same time share the job's threads.
+            threads = None if payload['CPU Threads'] is None else max(1, payload['CPU Threads'] // len(gpu_ids))
+            chunked_generation.send_concurrently(chunk_payloads_to_generate, gpu_ids,
+                                                 lambda chunk_payload: send_payload(
+                                                     {**chunk_payload, 'CPU Threads': threads}, tab_object),
+                                                 lambda chunk_payload: cancel_on_server(chunk_payload, tab_object),
+                                                 report_finished_chunk)
+
+    report_ready_chunks()
+    if uncached_chunk_payloads:
+        generate_chunks(uncached_chunk_payloads)
+    # Check that every chunk is still there right before stitching. If the session's other jobs generated so many
+    # chunks in the meantime that they pruned some of this job's, generate those again instead of failing the job.
+    missing_chunk_payloads = [chunk_payload for chunk_payload in unique_chunk_payloads
+                              if not chunk_store.contains(cache, session_data['id'], Stage.OUTPUT,
+                                                          chunk_payload['Output File'])]
+    if missing_chunk_payloads:
+        cached_chunks -= {chunk_payload['Output File'] for chunk_payload in missing_chunk_payloads}
+        generate_chunks(missing_chunk_payloads)
+    data_output, sr_output = chunked_generation.stitch(
+        [cache.read_audio_from_cache(Stage.OUTPUT, chunk_store_id, chunk_payload['Output File'])
+         for chunk_payload in chunk_payloads])
+    cache.save_audio_to_cache(Stage.OUTPUT, session_data['id'], payload['Output File'], data_output, sr_output)
+    chunk_store.prune(cache, session_data['id'],
+                      hashes_inputs | {chunk_payload['Output File'] for chunk_payload in chunk_payloads})
+    return sum(chunk_payload['Output File'] in cached_chunks for chunk_payload in chunk_payloads)
+
+
+def send_payload(payload, tab_object):
+    try:
+        response = architecture_client.post(tab_object, '/generate', payload)
+    except SystemExit:
+        # The worker process is being terminated, either because the user cancelled the job (Dash revokes the celery task
+        # with SIGTERM, which billiard turns into SystemExit) or because the worker is shutting down. Dropping the
+        # connection does not stop the architecture server, so tell it to stop generating output nobody will see.
+        cancel_on_server(payload, tab_object)
+        raise
+    code = response.status_code
 
     if code != 200:
         # Something went wrong, so throw an Exception.
@@ -134,31 +449,92 @@ def send_payload(payload, host, port):
         raise Exception(message)
 
 
+def send_batched_payloads(payloads, tab_object):
+    # Send several payloads in a single request (see batching.py). Return False if the architecture server doesn't
+    # support batched requests.
+    try:
+        response = architecture_client.post(tab_object, '/generate-batch', {'Payloads': payloads})
+    except SystemExit:
+        for payload in payloads:
+            cancel_on_server(payload, tab_object)
+        raise
+    code = response.status_code
+    if code == 404:
+        return False
+    if code != 200:
+        raise Exception(extract_message(response))
+    return True
+
+
+def cancel_on_server(payload, tab_object):
+    try:
+        # The generate requests being cancelled may hold every one of this process's slots for the server, so don't wait
+        # for one.
+        architecture_client.post(tab_object, '/cancel', {'Output File': payload['Output File']},
+                                 read_timeout=CANCEL_TIMEOUT, bypass_limit=True)
+    except Exception:
+        # Older architecture servers have no /cancel endpoint. The job is going away regardless, so just log it.
+        traceback.print_exc()
+
+
 def extract_message(response):
-    json_response = json.loads(response.read().decode('utf-8'))
+    json_response = response.json()
     base64_encoded_message = json_response['message']
     return base64.b64decode(base64_encoded_message).decode('utf-8')
 
 
-def verify_output_exists(cache, hash_output, session_data):
+def record_generation_time(cache, tab_object, options, user_text, hash_preprocessed, session_data, gpu_id, seconds):
+    # Feed the cost model, which predicts how long future requests will take.
+    hash_raw = None if hash_preprocessed is None else \
+        pcc.read_metadata_entry(cache, Stage.PREPROCESSED, session_data['id'], hash_preprocessed).get('Raw File')
+    features = cost_model.job_features(tab_object, options, user_text,
+                                       cost_model.input_audio_seconds(cache, session_data['id'], hash_raw))
     try:
-        cache.read_audio_from_cache(Stage.OUTPUT, session_data['id'], hash_output)
-    except Exception as e:
-        raise Exception("Payload was sent, but output file was not produced.") from e
+        cost_model.record(tab_object, gpu_id != '', features, seconds)
+    except redis.exceptions.ConnectionError:
+        pass  # The cost model is only used for scheduling and estimates. Don't fail the request over it.
 
 
-def write_output_metadata(cache, hash_preprocessed, user_text, hash_output, tab_object, relevant_inputs, session_data):
-    output_metadata = cache.read_metadata(Stage.OUTPUT, session_data['id'])
+def estimate_generation_time(cache_type, session_data, user_text, selected_file, selected_architectures, args, on_gpu):
+    """Return the number of seconds the architecture server is predicted to take to generate output for a request, or
+    None if there is no prediction. The arguments are the same as the arguments of generate()."""
+    cache = hsc.select_cache_implementation(cache_type)
+    tab_object = get_selected_tab_object(selected_architectures, args[0:len(selected_architectures)])
+    if tab_object is None:
+        return None
+    relevant_inputs = get_inputs_for_selected_tab(selected_architectures, tab_object, args[len(selected_architectures):])
+    options = tab_object.construct_input_dict(session_data, *relevant_inputs)
+    hash_raw = None if selected_file is None else pcc.lookup_filehash(cache, selected_file, session_data)
+    features = cost_model.job_features(tab_object, options, user_text,
+                                       cost_model.input_audio_seconds(cache, session_data['id'], hash_raw))
+    return cost_model.predict(tab_object, on_gpu, features)
+
 
-    output_metadata[hash_output] = {
+def verify_output_exists(cache, hash_output, session_data):
+    # Check for the file without decoding it, unless the cache implementation doesn't keep its audio in files. A
+    # JobContext then keeps the decoded audio for postprocessing.
+    context = cache if isinstance(cache, JobContext) else JobContext(cache)
+    if not context.audio_file_exists(Stage.OUTPUT, session_data['id'], hash_output):
+        raise Exception("Payload was sent, but output file was not produced.")
+
+
+def adopt_output(cache, leader_session_id, leader_hash_output, hash_output, session_data):
+    # Copy the output of an identical request into this request's session, under this request's hash.
+    if leader_session_id == session_data['id'] and leader_hash_output == hash_output:
+        return
+    data_output, sr_output = cache.read_audio_from_cache(Stage.OUTPUT, leader_session_id, leader_hash_output)
+    cache.save_audio_to_cache(Stage.OUTPUT, session_data['id'], hash_output, data_output, sr_output)
+
+
+def write_output_metadata(cache, hash_preprocessed, user_text, hash_output, options, session_data):
+    pcc.write_metadata_entry(cache, Stage.OUTPUT, session_data['id'], hash_output, {
         'Inputs': {
             'Preprocessed File': hash_preprocessed,
             'User Text': user_text
         },
-        'Options': tab_object.construct_input_dict(session_data, *relevant_inputs),
+        'Options': options,
         'Time of Creation': datetime.datetime.now().strftime(hsc.cache.TIMESTAMP_FORMAT)
-    }
-    cache.write_metadata(Stage.OUTPUT, session_data['id'], output_metadata)
+    })
 
 
 def postprocess(cache, hash_output, reduce_metallic_noise, auto_tune_output, output_speed_adjustment, session_data):
@@ -171,7 +547,9 @@ def postprocess(cache, hash_output, reduce_metallic_noise, auto_tune_output, out
     hash_postprocessed = pcc.compute_next_hash(hash_output, reduce_metallic_noise, auto_tune_output,
                                            output_speed_adjustment)
     if cache.file_is_already_cached(Stage.POSTPROCESSED, session_data['id'], hash_postprocessed):
-        return hash_postprocessed
+        # Only reproducible requests get here. Refresh the timestamp so the reused output is shown as the newest one.
+        refresh_postprocessed_timestamp(cache, hash_postprocessed, session_data)
+        return hash_postprocessed, False
 
     # Perform postprocessing
     data_output, sr_output = cache.read_audio_from_cache(Stage.OUTPUT, session_data['id'], hash_output)
@@ -186,7 +564,7 @@ def postprocess(cache, hash_output, reduce_metallic_noise, auto_tune_output, out
     write_postprocessed_metadata(cache, hash_output, hash_postprocessed, reduce_metallic_noise, auto_tune_output,
                                  output_speed_adjustment, session_data)
 
-    return hash_postprocessed
+    return hash_postprocessed, True
 
 
 def postprocess_bytes(bytes_output, sr_output, reduce_metallic_noise, auto_tune_output, output_speed_adjustment):
@@ -199,8 +577,7 @@ def write_postprocessed_metadata(cache, hash_output, hash_postprocessed, reduce_
     processing_options, user_text, hash_preprocessed = get_process_info(cache, hash_output, session_data)
     selected_file, preprocess_options = get_preprocess_info(cache, hash_preprocessed, session_data)
 
-    postprocessed_metadata = cache.read_metadata(Stage.POSTPROCESSED, session_data['id'])
-    postprocessed_metadata[hash_postprocessed] = {
+    metadata = {
         'Inputs': {
             'User File': selected_file,
             'User Text': user_text
@@ -214,14 +591,22 @@ def write_postprocessed_metadata(cache, hash_output, hash_postprocessed, reduce_
         },
         'Time of Creation': datetime.datetime.now().strftime(hsc.cache.TIMESTAMP_FORMAT)
     }
-    cache.write_metadata(Stage.POSTPROCESSED, session_data['id'], postprocessed_metadata)
+    pcc.write_metadata_entry(cache, Stage.POSTPROCESSED, session_data['id'], hash_postprocessed, metadata)
+    output_index.add_to_index(cache, session_data['id'], hash_postprocessed, metadata)
+
+
+def refresh_postprocessed_timestamp(cache, hash_postprocessed, session_data):
+    metadata = pcc.read_metadata_entry(cache, Stage.POSTPROCESSED, session_data['id'], hash_postprocessed)
+    metadata = {**metadata, 'Time of Creation': datetime.datetime.now().strftime(hsc.cache.TIMESTAMP_FORMAT)}
+    pcc.write_metadata_entry(cache, Stage.POSTPROCESSED, session_data['id'], hash_postprocessed, metadata)
+    output_index.add_to_index(cache, session_data['id'], hash_postprocessed, metadata)
 
 
 def get_process_info(cache, hash_output, session_data):
-    output_metadata = cache.read_metadata(Stage.OUTPUT, session_data['id'])
-    processing_options = output_metadata.get(hash_output).get('Options')
-    user_text = output_metadata.get(hash_output).get('Inputs').get('User Text')
-    hash_preprocessed = output_metadata.get(hash_output).get('Inputs').get('Preprocessed File')
+    output_metadata = pcc.read_metadata_entry(cache, Stage.OUTPUT, session_data['id'], hash_output)
+    processing_options = output_metadata.get('Options')
+    user_text = output_metadata.get('Inputs').get('User Text')
+    hash_preprocessed = output_metadata.get('Inputs').get('Preprocessed File')
     return processing_options, user_text, hash_preprocessed
 
 
@@ -230,10 +615,11 @@ def get_preprocess_info(cache, hash_preprocessed, session_data):
         selected_file = None
         preprocess_options = None
     else:
-        preprocess_metadata = cache.read_metadata(Stage.PREPROCESSED, session_data['id'])
-        preprocess_options = preprocess_metadata.get(hash_preprocessed).get('Options')
-        hash_raw = preprocess_metadata.get(hash_preprocessed).get('Raw File')
+        preprocess_metadata = pcc.read_metadata_entry(cache, Stage.PREPROCESSED, session_data['id'],
+                                                      hash_preprocessed)
+        preprocess_options = preprocess_metadata.get('Options')
+        hash_raw = preprocess_metadata.get('Raw File')
 
-        raw_metadata = cache.read_metadata(Stage.RAW, session_data['id'])
-        selected_file = raw_metadata.get(hash_raw).get('User File')
+        raw_metadata = pcc.read_metadata_entry(cache, Stage.RAW, session_data['id'], hash_raw)
+        selected_file = raw_metadata.get('User File')
     return selected_file, preprocess_options
@@ -0,0 +1,76 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+import coordination
+
+# GPU celery workers don't own a GPU. Instead, a worker leases one of the GPUs that the selected architecture can see
+# for the duration of a job and gives it back afterward, so any number of workers can share any number of GPUs and a job
+# is never sent to a GPU that its architecture cannot use. A lease is a Redis key that expires on its own, in case the
+# worker holding it dies.
+# Note: GPUs are identified by the index that the architecture containers report in /gpu-info, which assumes that all
+# containers enumerate the GPUs in the same order (true when every container is given all GPUs).
+
+KEY_PREFIX = 'hay_say:gpu_lease:'
+LEASE_TIMEOUT = 3600  # seconds
+POLL_INTERVAL = 0.5  # seconds
+
+
+@contextmanager
+def lease_gpu(tab_object, on_wait=None):
+    """Lease a free GPU from among the GPUs that the given architecture supports, waiting for one to become free if
+    necessary, and yield its ID. The lease is released when the with block exits. on_wait is called once, with a message
+    for the user, if all supported GPUs are busy."""
+    gpu_ids = gpu_ids_by_free_memory(tab_object)
+    if not gpu_ids:
+        raise Exception('No GPU is available for ' + tab_object.label + '. Please generate on the CPU instead.')
+    token = uuid.uuid4().hex
+    client = coordination.redis_client()
+    waiting = False
+    while True:
+        gpu_id = next((gpu_id for gpu_id in gpu_ids if client.set(KEY_PREFIX + str(gpu_id), token, nx=True,
+                                                                  ex=LEASE_TIMEOUT)), None)
+        if gpu_id is not None:
+            break
+        if not waiting and on_wait is not None:
+            on_wait('Waiting for a free GPU...')
+        waiting = True
+        time.sleep(POLL_INTERVAL)
+    try:
+        yield gpu_id
+    finally:
+        coordination.release_lock(KEY_PREFIX + str(gpu_id), token)
+
+
+@contextmanager
+def lease_idle_gpus(tab_object, max_count):
+    """Lease up to max_count of the GPUs that the given architecture supports, but only ones that are free right now,
+    and yield a list of their IDs (possibly empty). The leases are released when the with block exits."""
+    token = uuid.uuid4().hex
+    client = coordination.redis_client()
+    gpu_ids = []
+    try:
+        for gpu_id in supported_gpu_ids(tab_object) if max_count > 0 else []:
+            if client.set(KEY_PREFIX + str(gpu_id), token, nx=True, ex=LEASE_TIMEOUT):
+                gpu_ids.append(gpu_id)
+                if len(gpu_ids) == max_count:
+                    break
+        yield gpu_ids
+    finally:
+        for gpu_id in gpu_ids:
+            coordination.release_lock(KEY_PREFIX + str(gpu_id), token)
+
+
+def supported_gpu_ids(tab_object):
+    # The GPU list is cached by the tab (see AbstractTab.supported_gpus), so this doesn't query the architecture.
+    return [gpu_info['Index'] for gpu_info in tab_object.supported_gpus]
+
+
+def gpu_ids_by_free_memory(tab_object):
+    # Prefer the GPU with the most free memory, so that work is spread across GPUs when several are free. The cached GPU
+    # list has stale memory figures, so the architecture is asked for current ones, but only when there is a choice.
+    gpu_ids = supported_gpu_ids(tab_object)
+    if len(gpu_ids) < 2:
+        return gpu_ids
+    free_memory = {gpu_info['Index']: gpu_info['Free Memory'] for gpu_info in tab_object.fetch_gpu_info()}
+    return sorted(gpu_ids, key=lambda gpu_id: free_memory.get(gpu_id, 0), reverse=True)
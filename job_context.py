@@ -0,0 +1,63 @@
+import os
+
+import plotly_celery_common as pcc
+
+
+class JobContext:
+    """Wraps a cache implementation for the duration of a single generate job and remembers the decoded audio and the
+    metadata entries that the job reads from or writes to the cache, so that each stage of the job can pick up what the
+    stages before it already have in memory instead of reading it from the cache again. It can be passed anywhere a
+    cache implementation is expected. Anything it doesn't remember is passed through to the cache itself.
+
+    A JobContext must not outlive its job, since it doesn't notice changes that other jobs make to the cache.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.audio = {}  # (stage, session_id, filename_sans_extension) -> (data array, sample rate)
+        self.metadata_entries = {}  # (stage, session_id, filename_sans_extension) -> metadata entry
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def read_audio_from_cache(self, stage, session_id, filename_sans_extension):
+        key = (stage, session_id, filename_sans_extension)
+        if key not in self.audio:
+            self.audio[key] = self.cache.read_audio_from_cache(stage, session_id, filename_sans_extension)
+        return self.audio[key]
+
+    def save_audio_to_cache(self, stage, session_id, filename_sans_extension, array, samplerate):
+        self.cache.save_audio_to_cache(stage, session_id, filename_sans_extension, array, samplerate)
+        self.audio[(stage, session_id, filename_sans_extension)] = (array, samplerate)
+
+    def read_metadata_entry(self, stage, session_id, filename_sans_extension):
+        key = (stage, session_id, filename_sans_extension)
+        if key not in self.metadata_entries:
+            entry = pcc.read_metadata_entry(self.cache, stage, session_id, filename_sans_extension)
+            if entry is None:
+                return None  # Don't remember a missing entry. The job may be about to write it.
+            self.metadata_entries[key] = entry
+        return self.metadata_entries[key]
+
+    def write_metadata_entry(self, stage, session_id, filename_sans_extension, entry):
+        pcc.write_metadata_entry(self.cache, stage, session_id, filename_sans_extension, entry)
+        self.metadata_entries[(stage, session_id, filename_sans_extension)] = entry
+
+    def file_is_already_cached(self, stage, session_id, filename_sans_extension):
+        # Like the cache implementations, this goes by the metadata, not by the audio file itself.
+        return self.read_metadata_entry(stage, session_id, filename_sans_extension) is not None
+
+    def audio_file_exists(self, stage, session_id, filename_sans_extension):
+        """Return True if the audio file itself is in the cache, whether or not it has a metadata entry yet (the
+        architecture servers write the output file, but its metadata is written afterward). The file is only read if
+        the cache implementation doesn't keep its audio in files, and then it is remembered for the stages to come."""
+        if (stage, session_id, filename_sans_extension) in self.audio:
+            return True
+        path = pcc.cache_file_path(self.cache, stage, session_id, filename_sans_extension)
+        if path is not None:
+            return os.path.isfile(path)
+        try:
+            self.read_audio_from_cache(stage, session_id, filename_sans_extension)
+        except Exception:
+            return False
+        return True
@@ -0,0 +1,265 @@
+import json
+import traceback
+import uuid
+from contextlib import contextmanager
+
+import redis
+from _plotly_utils.utils import PlotlyJSONEncoder
+from celery import chain, states
+from celery.exceptions import Ignore
+from celery.signals import task_postrun, task_prerun, task_revoked
+from dash import CeleryManager
+
+import admission
+import architecture_slots
+import fair_share
+import pipeline_stages
+
+
+class GenerateJobManager(CeleryManager):
+    """A CeleryManager for the generate callbacks. Compared to the CeleryManager it extends, it:
+    * sends each job to a celery queue named after the architecture the job is for, instead of to celery's default
+      queue. Each architecture can then be served by its own celery workers (see the --serve_architecture option of
+      celery_generate_cpu and celery_generate_gpu), so that slow jobs for one architecture don't hold up the others.
+    * shares the workers fairly between sessions and limits the number of jobs each session can have in flight (see
+      fair_share.py).
+    * turns jobs away when their queue is already too long and tells waiting users their position in the queue and
+      roughly how long they will wait (see admission.py).
+    * puts jobs back in their queue instead of running them while their architecture server is already as busy as it is
+      allowed to be (see architecture_slots.py).
+    * can run each job as a chain of separate tasks for preprocessing, generating the output and postprocessing, so that
+      the workers serving the architecture queues only wait on architecture servers (see pipeline_stages.py).
+    The celery app must be configured with fair_share.BROKER_TRANSPORT_OPTIONS.
+
+    hardware is 'GPU' or 'CPU'. GPU and CPU jobs go through separate celery apps whose queues have the same names, so the
+    hardware is part of the name under which admission.py tracks a queue.
+
+    The manager learns about a job from the arguments of the background callback (excluding set_progress):
+    select_queue(callback_args) returns the name of the queue for the job (or None for celery's default queue),
+    select_session_id(callback_args) returns the ID of the session that requested the job,
+    reject(callback_args, message) returns the output of the callback for a job that is not allowed to run,
+    estimate_cost(callback_args) returns the predicted run time of the job in seconds, or None (see cost_model.py), and
+    describe_progress(message) returns the progress of the callback for a job that is still waiting in its queue.
+    stages is a generator.GenerateStages that runs the stages of the callback one at a time, or None if the jobs must
+    always run in a single task.
+    follow(callback_args) waits for an identical job or a batch to produce the job's output, if it can, and returns True
+    if it did (see generator.follow_identical_request). It is called before the job takes an architecture slot."""
+
+    def __init__(self, celery_app, hardware, select_queue, select_session_id, reject, estimate_cost, describe_progress,
+                 stages=None, follow=None, cache_by=None, expire=None):
+        super().__init__(celery_app, cache_by, expire)
+        self.hardware = hardware
+        self.select_queue = select_queue
+        self.select_session_id = select_session_id
+        self.reject = reject
+        self.estimate_cost = estimate_cost
+        self.describe_progress = describe_progress
+        self.stages = stages
+        self.follow = follow
+        if stages is not None:
+            self.register_stage_tasks()
+
+    def call_job_fn(self, key, job_fn, args, context):
+        job_id = uuid.uuid4().hex
+        queue = self.select_queue(args)
+        try:
+            rank = fair_share.admit(fair_share.requester_key(self.select_session_id(args)), job_id)
+            if rank is None:
+                self.finish_without_running(key, self.reject(args, 'You already have the maximum number of generation '
+                                                                   'requests in progress. Please wait for one of them '
+                                                                   'to finish and then try again.'))
+                return job_id
+            predicted_seconds = self.predict_run_time(args)
+            priority = fair_share.priority(rank, admission.is_short_job(self.admission_queue(args), predicted_seconds))
+            if not admission.enqueue(self.admission_queue(args), job_id, priority, key, predicted_seconds):
+                fair_share.finish(job_id)
+                self.finish_without_running(key, self.reject(args, 'Hay Say is very busy right now and cannot accept '
+                                                                   'any more requests for this architecture. Please '
+                                                                   'try again in a few minutes.'))
+                return job_id
+        except redis.exceptions.ConnectionError:
+            # Fair sharing and admission control are niceties. Don't refuse to generate anything just because Redis is
+            # unavailable.
+            priority = 0
+        if self.runs_stages_separately():
+            self.call_stages(key, job_id, args, queue, priority)
+            return job_id
+        task = job_fn.apply_async(args=(key, self._make_progress_key(key), args, context), task_id=job_id,
+                                  queue=queue, priority=priority)
+        return task.task_id
+
+    def make_job_fn(self, fn, progress, key=None):
+        run_job = super().make_job_fn(fn, progress, key)
+
+        @self.handle.task(name=f'generate_{key}', bind=True, max_retries=None)
+        def job_fn(task, result_key, progress_key, user_callback_args, context=None):
+            with self.architecture_slot(task, user_callback_args):
+                run_job(result_key, progress_key, user_callback_args, context)
+
+        return job_fn
+
+    @contextmanager
+    def architecture_slot(self, task, callback_args):
+        # Hold one of the slots of the job's architecture while the job runs, or put the job back in its queue if they
+        # are all taken. Each queue is named after the architecture that its jobs are for. A job whose output was
+        # produced by an identical job or a batch only needs to be postprocessed, so it doesn't take a slot.
+        if self.follows_other_job(callback_args):
+            yield
+            return
+        with architecture_slots.slot(self.select_queue(callback_args) or DEFAULT_QUEUE) as has_slot:
+            if not has_slot:
+                raise task.retry(countdown=architecture_slots.RETRY_DELAY)
+            yield
+
+    def follows_other_job(self, callback_args):
+        if self.follow is None:
+            return False
+        try:
+            return self.follow(callback_args)
+        except Exception:
+            # The job will run into the same problem and report it when it runs.
+            traceback.print_exc()
+            return False
+
+    def runs_stages_separately(self):
+        return self.stages is not None and pipeline_stages.is_enabled()
+
+    def register_stage_tasks(self):
+        # Each task of the chain gets the output of the one before it as its first argument.
+        hardware = self.hardware.lower()
+
+        @self.handle.task(name=f'preprocess_{hardware}')
+        def preprocess(job_id, result_key, progress_key, callback_args):
+            try:
+                return self.run_stage(result_key, lambda: self.stages.preprocess(callback_args))
+            except Ignore:
+                # The rest of the chain won't run, so the job is done.
+                finish_job_stages(job_id)
+                raise
+
+        @self.handle.task(name=f'generate_output_file_{hardware}', bind=True, max_retries=None)
+        def generate_output_file(task, hash_preprocessed, result_key, progress_key, callback_args):
+            def set_progress(progress_value):
+                self.handle.backend.set(progress_key, json.dumps(progress_value, cls=PlotlyJSONEncoder))
+
+            with self.architecture_slot(task, callback_args):
+                return self.run_stage(result_key, lambda: self.stages.generate_output_file(set_progress, callback_args,
+                                                                                           hash_preprocessed))
+
+        @self.handle.task(name=f'postprocess_{hardware}')
+        def postprocess(hash_output, result_key, progress_key, callback_args):
+            output = self.run_stage(result_key, lambda: self.stages.postprocess(callback_args, hash_output))
+            self.finish_without_running(result_key, output)
+
+        self.preprocess_task = preprocess
+        self.generate_output_file_task = generate_output_file
+        self.postprocess_task = postprocess
+
+    def run_stage(self, result_key, stage):
+        try:
+            return stage()
+        except Exception:
+            # Show the error as the output of the job, and don't run the rest of the chain.
+            self.finish_without_running(result_key, self.stages.display_error())
+            raise Ignore()
+
+    def call_stages(self, key, job_id, args, queue, priority):
+        stage_args = (key, self._make_progress_key(key), args)
+        chain(self.preprocess_task.si(job_id, *stage_args).set(
+                  queue=pipeline_stages.PREPROCESS_QUEUE, priority=priority,
+                  task_id=pipeline_stages.stage_task_id(job_id, pipeline_stages.PREPROCESS_QUEUE)),
+              self.generate_output_file_task.s(*stage_args).set(
+                  queue=queue or DEFAULT_QUEUE, priority=priority, task_id=job_id),
+              self.postprocess_task.s(*stage_args).set(
+                  queue=pipeline_stages.POSTPROCESS_QUEUE, priority=priority,
+                  task_id=pipeline_stages.stage_task_id(job_id, pipeline_stages.POSTPROCESS_QUEUE))).apply_async()
+
+    def stage_task_ids(self, job):
+        return [pipeline_stages.stage_task_id(job, queue) for queue in pipeline_stages.STAGE_QUEUES]
+
+    def terminate_job(self, job):
+        super().terminate_job(job)
+        if job is not None and self.runs_stages_separately():
+            for task_id in self.stage_task_ids(job):
+                super().terminate_job(task_id)
+            # If the job is cancelled during preprocessing, the task with the job's ID is never sent to a worker, so no
+            # worker will report it as revoked.
+            try:
+                finish_job_stages(job)
+            except redis.exceptions.ConnectionError:
+                pass
+
+    def job_running(self, job):
+        if not job or not self.runs_stages_separately():
+            return super().job_running(job)
+        # The job is running until its last stage is done, unless one of its stages was revoked or died.
+        if any(self.handle.AsyncResult(task_id).status in (states.FAILURE, states.REVOKED)
+               for task_id in [job] + self.stage_task_ids(job)):
+            return False
+        return super().job_running(pipeline_stages.stage_task_id(job, pipeline_stages.POSTPROCESS_QUEUE))
+
+    def get_progress(self, key):
+        progress = super().get_progress(key)
+        if progress is not None:
+            return progress
+        # The job hasn't reported any progress. If it is still waiting in its queue, say where.
+        try:
+            wait_description = admission.describe_wait(key)
+        except redis.exceptions.ConnectionError:
+            return None
+        return None if wait_description is None else self.describe_progress(wait_description)
+
+    def admission_queue(self, args):
+        # The name under which admission.py tracks the queue that the job is sent to.
+        return self.hardware.lower() + ':' + (self.select_queue(args) or DEFAULT_QUEUE)
+
+    def predict_run_time(self, args):
+        try:
+            return self.estimate_cost(args)
+        except redis.exceptions.ConnectionError:
+            raise
+        except Exception:
+            # A prediction is only used for scheduling and estimates, so a job must never fail just because its
+            # prediction could not be made.
+            traceback.print_exc()
+            return None
+
+    def finish_without_running(self, key, output):
+        # Store the output for Dash to pick up as if a worker had produced it. The job itself is never sent to celery.
+        self.handle.backend.set(key, json.dumps(output, cls=PlotlyJSONEncoder))
+
+
+DEFAULT_QUEUE = 'celery'
+
+
+def queue_name(tab):
+    return tab.id
+
+
+@task_prerun.connect
+def start_job(task_id=None, **_):
+    admission.start(task_id)
+
+
+# Jobs stop counting against their session's limit and their queue's length as soon as a worker is done with them.
+@task_postrun.connect
+def finish_job(task_id=None, state=None, **_):
+    if state == states.RETRY:
+        # The job went back into its queue to wait for a free slot (see make_job_fn). It isn't done yet.
+        admission.requeue(task_id)
+        return
+    fair_share.finish(task_id)
+    admission.finish(task_id)
+
+
+@task_revoked.connect
+def finish_revoked_job(request=None, **_):
+    fair_share.finish(request.id)
+    admission.finish(request.id)
+
+
+def finish_job_stages(job_id):
+    # Called for a job whose stages run as separate tasks (see pipeline_stages.py) when it ends before the task with the
+    # job's ID has run.
+    fair_share.finish(job_id)
+    admission.finish(job_id)
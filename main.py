@@ -9,13 +9,19 @@ import uuid
 
 import dash_bootstrap_components as dbc
 import soundfile
-from dash import Dash, html, dcc, Input, Output, State, ctx, callback, MATCH
+from dash import Dash, html, dcc, Input, Output, State, ctx, callback, clientside_callback, ClientsideFunction, MATCH, \
+    Patch
 from dash.exceptions import PreventUpdate
 from hay_say_common.cache import Stage
 
+import admission
+import fair_share
 import hay_say_common as hsc
+import pipeline_stages
 import plotly_celery_common as pcc
+from audio_streaming import construct_audio_url, register_audio_route
 from deletion_scheduler import register_cache_cleanup_callback
+from postprocessed_display import prepare_output_history_page
 
 # todo: so-vits output is much louder than controllable talknet. Should the output volume be equalized?
 
@@ -171,6 +177,15 @@ def construct_main_interface(tab_buttons, tabs_contents, enable_session_caches):
                             className='centered'
                         ),
                     ),
+                    html.Tr(
+                        html.Td(
+                            dcc.Loading(
+                                html.Button('Generate!', id='generate-button-auto', className='generate-button'),
+                                type='default'  # circle, graph, cube, circle, dot, default
+                            ),
+                            className='no-padding'
+                        ),
+                    ),
                     html.Tr(
                         html.Td(
                             dcc.Loading(
@@ -194,6 +209,23 @@ def construct_main_interface(tab_buttons, tabs_contents, enable_session_caches):
                             html.Span('Waiting in queue...', id='generate-message', hidden=True),
                             className='centered'
                         ),
+                    ),
+                    html.Tr(
+                        html.Td([
+                            # Plays the beginning of a long output while the rest is still being generated. See
+                            # assets/progressive_playback.js
+                            dcc.Store(id='partial-output-playlist'),
+                            html.Audio(id='partial-output-player', controls=True, hidden=True),
+                        ], className='centered'),
+                    ),
+                    html.Tr(
+                        html.Td(
+                            # Dash routes a cancel button's clicks to a single background callback manager, so each
+                            # generate button has its own cancel button.
+                            html.Div([html.Button('Cancel', id='cancel-generate-button-' + hardware, hidden=True)
+                                      for hardware in ['auto', 'gpu', 'cpu']]),
+                            className='centered'
+                        ),
                     )],
                     className='generate-table'
                 ),
@@ -216,16 +248,20 @@ def construct_main_interface(tab_buttons, tabs_contents, enable_session_caches):
                 ]),
                 style={"width": "100%"}
             ),
-            html.Div(id='message'),
+            html.Div(html.Button('Load older outputs', id='load-older-outputs', hidden=True), className='centered'),
+            dcc.Store(id='output-history-cursor', storage_type='memory', data=None),
+            html.Div(id='message', children=[]),
         ], id='hay-say-outer-div', className='outer-div')
     ]
 
 
 def register_generate_callbacks(cache_type, architectures):
+    import auto_placement
     import celery_generate_gpu
     import celery_generate_cpu
-    celery_generate_gpu.CacheSelection(None, cache_type, architectures)
-    celery_generate_cpu.CacheSelection(None, cache_type, architectures)
+    gpu_step = celery_generate_gpu.CacheSelection(None, cache_type, architectures)
+    cpu_step = celery_generate_cpu.CacheSelection(None, cache_type, architectures)
+    auto_placement.register_auto_callback(architectures, gpu_step, cpu_step)
 
 
 def register_main_callbacks(enable_session_caches, cache_type, architectures):
@@ -295,22 +331,52 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
         return False
 
     @callback(
-        [Output('generate-button-gpu', 'hidden'),
+        [Output('generate-button-auto', 'hidden'),
+         Output('generate-button-gpu', 'hidden'),
          Output('generate-button-cpu', 'hidden')],
         Input('hardware-selector', 'value')
     )
     def select_generate_button(hardware_selection):
-        return hardware_selection != 'GPU', hardware_selection != 'CPU'
+        return hardware_selection != 'Auto', hardware_selection != 'GPU', hardware_selection != 'CPU'
+
+    clientside_callback(
+        ClientsideFunction(namespace='progressive_playback', function_name='play_ready_chunks'),
+        Output('partial-output-player', 'title'),  # Not actually updated. Dash requires every callback to have an output.
+        Input('partial-output-playlist', 'data')
+    )
 
     @callback(
-        Output('message', 'children', allow_duplicate=True),
+        [Output('message', 'children'),
+         Output('output-history-cursor', 'data'),
+         Output('load-older-outputs', 'hidden')],
+        [Input('session', 'data'),
+         Input('load-older-outputs', 'n_clicks')],
+        State('output-history-cursor', 'data')
+    )
+    def load_output_history(session_data, _, oldest_displayed_timestamp):
+        if ctx.triggered_id == 'load-older-outputs':
+            # Put the next page of older outputs in front of the outputs that are already displayed.
+            displays, oldest_timestamp, has_older_outputs = prepare_output_history_page(cache, session_data,
+                                                                                         oldest_displayed_timestamp)
+            displayed_outputs = Patch()
+            for display in reversed(displays):
+                displayed_outputs.prepend(display)
+        else:
+            # The page was just loaded, so display the newest page of outputs.
+            displayed_outputs, oldest_timestamp, has_older_outputs = prepare_output_history_page(cache, session_data)
+        return displayed_outputs, oldest_timestamp, not has_older_outputs
+
+    @callback(
+        [Output('message', 'children', allow_duplicate=True),
+         Output('output-history-cursor', 'data', allow_duplicate=True),
+         Output('load-older-outputs', 'hidden', allow_duplicate=True)],
         Input('delete-postprocessed', 'n_clicks'),
         State('session', 'data'),
         prevent_initial_call=True
     )
     def delete_all_postprocessed(_, session_data):
         cache.delete_all_files_at_stage(Stage.POSTPROCESSED, session_data['id'])
-        return ''
+        return [], None, True
 
     gpt_so_vits_tab = pcc.architecture_map().get('GPTSoVITS', None)
     if gpt_so_vits_tab is not None:
@@ -458,12 +524,10 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
             write_raw_metadata(hash_raw, filename, session_data)
 
     def write_raw_metadata(hash_80_bits, filename, session_data):
-        raw_metadata = cache.read_metadata(Stage.RAW, session_data['id'])
-        raw_metadata[hash_80_bits] = {
+        pcc.write_metadata_entry(cache, Stage.RAW, session_data['id'], hash_80_bits, {
             'User File': filename,
             'Time of Creation': datetime.datetime.now().strftime(hsc.cache.TIMESTAMP_FORMAT)
-        }
-        cache.write_metadata(Stage.RAW, session_data['id'], raw_metadata)
+        })
 
     @callback(
         [Output('input-playback', 'src'),
@@ -477,9 +541,7 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
         metadata = cache.read_metadata(Stage.RAW, session_data['id'])
         reverse_lookup = {metadata[key]['User File']: key for key in metadata}
         hash_raw = reverse_lookup[selected_file]
-        bytes_raw = cache.read_file_bytes(Stage.RAW, session_data['id'], hash_raw)
-        src = pcc.prepare_src_attribute(bytes_raw, hsc.cache.CACHE_MIMETYPE)
-        return src, False
+        return construct_audio_url(Stage.RAW, session_data['id'], hash_raw), False
 
     @callback(
         Output('postprocessing-options', 'hidden'),
@@ -489,7 +551,8 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
         return SHOW_OUTPUT_OPTIONS_LABEL not in value
 
     @callback(
-        [Output('generate-button-gpu', 'disabled'),
+        [Output('generate-button-auto', 'disabled'),
+         Output('generate-button-gpu', 'disabled'),
          Output('generate-button-cpu', 'disabled')],
         [Input('text-input', 'value'),
          Input('file-dropdown', 'value')] +
@@ -503,12 +566,12 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
         character_selections = hidden_states_and_character_selections[len(available_tabs):]
         tab_object = get_selected_tab_object(hidden_states)
         if tab_object is None:
-            return True, True
+            return True, True, True
         else:
             index = hidden_states.index(False)
             selected_character = character_selections[index]
             hidden = not tab_object.meets_requirements(user_text, selected_file, selected_character)
-            return hidden, hidden
+            return hidden, hidden, hidden
 
     # todo: disable the preview button if no audio file is selected.
     @callback(
@@ -527,10 +590,7 @@ def register_main_callbacks(enable_session_caches, cache_type, architectures):
 
         hash_preprocessed = pcc.preprocess(cache, selected_file, semitone_pitch, debug_pitch, reduce_noise, crop_silence)
 
-        # return src
-        bytes_preprocessed = cache.read_file_bytes(Stage.PREPROCESSED, session_data['id'], hash_preprocessed)
-        hash_raw = pcc.lookup_filehash(cache, selected_file, session_data)
-        return pcc.prepare_src_attribute(bytes_preprocessed, hsc.cache.CACHE_MIMETYPE)
+        return construct_audio_url(Stage.PREPROCESSED, session_data['id'], hash_preprocessed)
 
     def get_selected_tab_object(hidden_states):
         # Get the tab that is *not* hidden (i.e. hidden == False)
@@ -598,6 +658,10 @@ def parse_arguments(arguments):
     parser.add_argument('--enable_model_management', action='store_true', default=False, help='Enables the user to download and delete models.')
     parser.add_argument('--enable_session_caches', action='store_true', default=False, help='Maintain separate caches for each session. If not enabled, a single cache is used for all sessions.')
     parser.add_argument('--cache_implementation', default='file', choices=hsc.cache_implementation_map.keys(), help='Selects an implementation for the audio cache, e.g. saving them to files or to a database.')
+    parser.add_argument('--max_jobs_per_session', type=int, default=fair_share.DEFAULT_MAX_JOBS_PER_SESSION, help='The maximum number of generation requests that a single session (or a single IP address, if session caches are disabled) can have waiting or in progress at once.')
+    parser.add_argument('--max_queued_jobs', type=int, default=admission.DEFAULT_MAX_QUEUED_JOBS, help='The maximum number of generation requests that can wait in the queue of each architecture. Further requests are turned away until the queue gets shorter.')
+    parser.add_argument('--trusted_proxies', type=int, default=fair_share.DEFAULT_TRUSTED_PROXIES, help='The number of reverse proxies in front of Hay Say. The client IP address is then taken from the X-Forwarded-For header that they set. Leave this at 0 if clients connect to Hay Say directly, since clients can forge the header.')
+    parser.add_argument('--separate_pipeline_stages', action='store_true', default=False, help='Run the preprocessing and postprocessing of GPU jobs on a separate pool of celery workers, so that the GPU workers only wait on architecture servers. Requires celery_generate_gpu workers started with --serve_pipeline_stages.')
     parser.add_argument('--migrate_models', action='store_true', default=False, help='Automatically move models from the model pack directories and custom model directory to the new models directory when Hay Say starts.')
     # todo: this is hardcoded. fix it.
     parser.add_argument('--architectures', nargs='*', choices=['ControllableTalkNet', 'SoVitsSvc3', 'SoVitsSvc4', 'SoVitsSvc5', 'Rvc', 'StyleTTS2', 'GPTSoVITS'], default=['ControllableTalkNet', 'SoVitsSvc3', 'SoVitsSvc4', 'SoVitsSvc5', 'Rvc', 'StyleTTS2', 'GPTSoVITS'], help='Selects which architectures are shown in the Hay Say UI')
@@ -660,11 +724,18 @@ def register_cache_cleanup_callback_if_needed(enable_session_caches, cache_type)
 
 
 def build_app(architectures, update_model_lists_on_startup=False, enable_model_management=False, enable_session_caches=False,
-              cache_type='file', migrate_models=False):
+              cache_type='file', migrate_models=False, max_jobs_per_session=fair_share.DEFAULT_MAX_JOBS_PER_SESSION,
+              max_queued_jobs=admission.DEFAULT_MAX_QUEUED_JOBS, separate_pipeline_stages=False,
+              trusted_proxies=fair_share.DEFAULT_TRUSTED_PROXIES):
+    fair_share.configure(max_jobs_per_session)
+    admission.configure(max_queued_jobs)
+    pipeline_stages.configure(separate_pipeline_stages)
     app = construct_app_layout(enable_model_management, cache_type, architectures, enable_session_caches)
     register_app_callbacks(architectures, enable_model_management, enable_session_caches, cache_type)
     add_model_management_components_if_needed(cache_type, enable_model_management, architectures, app)
     register_cache_cleanup_callback_if_needed(enable_session_caches, cache_type)
+    register_audio_route(app.server, cache_type)
+    fair_share.trust_proxies(app.server, trusted_proxies)
 
     # Save some of the command-line options to the server object so that the server hook methods can get to them:
     app.server.update_model_lists_on_startup = update_model_lists_on_startup
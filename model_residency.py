@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import redis
+
+import architecture_client
+import coordination
+import hay_say_common as hsc
+
+# Each architecture server keeps the models it has loaded in memory, so a box that hosts several architectures can run
+# out of RAM or VRAM as users work their way through the characters. To keep the total bounded, every use of a model is
+# recorded in a table of the models that are probably loaded, ordered by when each was last used. Whenever the models in
+# the table add up to more than the memory budget, the least recently used ones are removed from the table and their
+# architecture servers are sent an /unload hint. Like /preload (see model_warmup.py), the hint is sent in the background
+# and its response is ignored, so servers without the endpoint just keep their models.
+#
+# The memory that a model takes up is estimated by the size of its files on disk.
+
+KEY_PREFIX = 'hay_say:model_residency:'
+DEFAULT_MEMORY_BUDGET = None  # gigabytes. None means models are never unloaded.
+UNLOAD_TIMEOUT = 5  # seconds. The server is expected to answer right away and unload the model afterward.
+
+_memory_budget = DEFAULT_MEMORY_BUDGET
+
+
+def configure(memory_budget=None):
+    global _memory_budget
+    _memory_budget = memory_budget if memory_budget is not None else _memory_budget
+
+
+def model_name(tab_object, character):
+    return tab_object.id + ':' + character
+
+
+def record_use(tab_object, character):
+    """Record that the character's model is being used (and is therefore loaded) on the architecture server, and unload
+    the least recently used models if the loaded models no longer fit in the memory budget."""
+    if character is None:
+        return
+    client = coordination.redis_client()
+    name = model_name(tab_object, character)
+    try:
+        if not client.hexists(KEY_PREFIX + 'sizes', name):
+            client.hset(KEY_PREFIX + 'sizes', name, model_size(tab_object, character))
+        pipeline = client.pipeline()
+        pipeline.zadd(KEY_PREFIX + 'last_used', {name: time.time()})
+        # Remember how to reach the server, since the process that unloads the model may not have a tab object for it.
+        pipeline.hset(KEY_PREFIX + 'ports', tab_object.id, tab_object.port)
+        pipeline.execute()
+        if _memory_budget is not None:
+            enforce_budget(client, name)
+    except redis.exceptions.ConnectionError:
+        pass  # Unloading is an optimization. Don't fail the request over it.
+
+
+def model_size(tab_object, character):
+    # The total size in bytes of the files in the character's model folder.
+    return sum(os.path.getsize(os.path.join(directory, filename))
+               for directory, _, filenames in os.walk(hsc.character_dir(tab_object.id, character))
+               for filename in filenames)
+
+
+def enforce_budget(client, protected_name):
+    # Unload the least recently used models until the rest fit in the budget. protected_name is the model that is about
+    # to be used, which is never unloaded.
+    names = client.zrange(KEY_PREFIX + 'last_used', 0, -1)
+    sizes = dict(zip(names, client.hmget(KEY_PREFIX + 'sizes', names))) if names else {}
+    total = sum(int(size or 0) for size in sizes.values())
+    for name in names:
+        if total <= _memory_budget * 1024 ** 3:
+            break
+        # Several workers may decide to unload the same model at once. Only the one that removes it sends the hint.
+        if name != protected_name and client.zrem(KEY_PREFIX + 'last_used', name):
+            total -= int(sizes[name] or 0)
+            architecture_id, _, character = name.partition(':')
+            # architecture_client only needs the server's id and port.
+            server = SimpleNamespace(id=architecture_id, port=int(client.hget(KEY_PREFIX + 'ports', architecture_id)))
+            threading.Thread(target=send_unload_hint, args=(server, character), daemon=True).start()
+
+
+def send_unload_hint(tab_object, character):
+    try:
+        architecture_client.post(tab_object, '/unload', {'Character': character}, read_timeout=UNLOAD_TIMEOUT)
+    except Exception:
+        pass  # It's only a hint. The server keeps the model loaded.
@@ -0,0 +1,50 @@
+import threading
+
+import redis
+
+import architecture_client
+import coordination
+import model_residency
+
+# Loading a character's model makes up much of the time that an architecture server takes for the first generation with
+# that character. When the user selects a character, the UI sends the architecture server a /preload hint so that the
+# server can load the model while the user is still typing, instead of after Generate is clicked. Hints are sent in the
+# background and their responses are ignored. A server without the endpoint just answers with a 404.
+#
+# Hints are deduplicated, so that a character is not hinted again (by any session) while its model is probably still
+# loaded, and rate limited per architecture, so that scrolling through the character list doesn't make the server load
+# the model of every character along the way.
+
+KEY_PREFIX = 'hay_say:model_warmup:'
+REPEAT_INTERVAL = 300  # seconds. Each character is hinted at most once per interval.
+MIN_HINT_INTERVAL = 2  # seconds. Each architecture server is sent at most one hint per interval.
+PRELOAD_TIMEOUT = 5  # seconds. The server is expected to answer right away and load the model afterward.
+
+
+def character_key(tab_object, character):
+    return KEY_PREFIX + 'character:' + tab_object.id + ':' + character
+
+
+def hint(tab_object, character):
+    """Ask the architecture server to load the character's model, unless the character was hinted recently or another
+    character was hinted a moment ago. Return True if a hint was sent."""
+    if character is None:
+        return False
+    client = coordination.redis_client()
+    try:
+        if client.exists(character_key(tab_object, character)) or \
+                not client.set(KEY_PREFIX + 'architecture:' + tab_object.id, 1, nx=True, ex=MIN_HINT_INTERVAL):
+            return False
+        client.set(character_key(tab_object, character), 1, ex=REPEAT_INTERVAL)
+    except redis.exceptions.ConnectionError:
+        return False  # Without Redis, hints can't be deduplicated or rate limited, so don't send any.
+    threading.Thread(target=send_hint, args=(tab_object, character), daemon=True).start()
+    model_residency.record_use(tab_object, character)
+    return True
+
+
+def send_hint(tab_object, character):
+    try:
+        architecture_client.post(tab_object, '/preload', {'Character': character}, read_timeout=PRELOAD_TIMEOUT)
+    except Exception:
+        pass  # It's only a hint. The model will be loaded when a job for the character arrives.
@@ -0,0 +1,138 @@
+import fcntl
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+from hay_say_common.cache import Stage, CACHE_EXTENSION
+
+INDEX_FILENAME = 'output_index.jsonl'
+LOCK_EXTENSION = '.lock'
+
+# The index is append-only, so lines for outputs that have since been evicted from the cache (or whose timestamps have
+# been refreshed) pile up over time. Rewrite the index once it grows past this many bytes.
+MAX_INDEX_SIZE = 256 * 1024
+READ_BLOCK_SIZE = 16 * 1024  # bytes. The index is read backward from its end in blocks of this size.
+
+
+def index_path(cache, session_id):
+    # The index lives next to the postprocessed metadata file so that deleting all files at the POSTPROCESSED stage
+    # also clears the index. Returns None if the cache implementation does not store its data in files.
+    if not hasattr(cache, 'map_folder'):
+        return None
+    return os.path.join(cache.map_folder(Stage.POSTPROCESSED, session_id), INDEX_FILENAME)
+
+
+def add_to_index(cache, session_id, hash_postprocessed, metadata):
+    """Record a postprocessed output in the index. This is a single appended line rather than a rewrite of the index,
+    so it is cheap no matter how many outputs the session has. 'metadata' must be the entry that was just written to the
+    postprocessed metadata for the output. It is stored in the index as well, so that a page of the output history can
+    be read from the index alone."""
+    path = index_path(cache, session_id)
+    if path is None or hasattr(cache, 'read_metadata_page'):
+        return
+    # Jobs of the same session (or every job, when session caches are disabled) may add to the index at the same time.
+    # Holding the lock keeps a rewrite from dropping lines that another job appends while it runs.
+    with index_lock(path):
+        if not os.path.isfile(path):
+            # Seed the index from the metadata, in case the session has outputs from before the index existed.
+            metadata_by_hash = cache.read_metadata(Stage.POSTPROCESSED, session_id)
+            rewrite_index(path, sorted(metadata_by_hash.items(), key=lambda entry: entry[1]['Time of Creation'],
+                                       reverse=True))
+        with open(path, 'a') as file:
+            file.write(json.dumps({'Hash': hash_postprocessed, 'Metadata': metadata}) + '\n')
+        if os.path.getsize(path) > MAX_INDEX_SIZE:
+            rewrite_index(path, list(valid_entries(cache, session_id, read_index_backward(path))))
+
+
+@contextmanager
+def index_lock(path):
+    # Hold an exclusive lock on the index while seeding, appending to or rewriting it. The lock is taken on a separate
+    # file because rewrite_index replaces the index file itself.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + LOCK_EXTENSION, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_page(cache, session_id, older_than=None, page_size=10):
+    """Return a list of up to page_size (hash, metadata) tuples for the newest postprocessed outputs created before
+    older_than, sorted from newest to oldest, and a boolean indicating whether there are even older outputs.
+    older_than is a timestamp string in hsc.cache.TIMESTAMP_FORMAT, or None to start from the newest output."""
+    if hasattr(cache, 'read_metadata_page'):
+        # The cache implementation keeps its own index of entries by time of creation (e.g. SqliteImpl).
+        return cache.read_metadata_page(Stage.POSTPROCESSED, session_id, older_than, page_size)
+    path = index_path(cache, session_id)
+    if path is None or not os.path.isfile(path):
+        entries = sorted(cache.read_metadata(Stage.POSTPROCESSED, session_id).items(),
+                         key=lambda entry: entry[1]['Time of Creation'], reverse=True)
+    else:
+        # Only the end of the index, where the newest outputs are, needs to be read. The metadata file isn't read at
+        # all.
+        entries = valid_entries(cache, session_id, read_index_backward(path))
+
+    # TIMESTAMP_FORMAT is zero-padded from the year down to the microsecond, so timestamps sort correctly as strings.
+    page = []
+    for hash_postprocessed, metadata in entries:
+        if older_than is None or metadata['Time of Creation'] < older_than:
+            if len(page) == page_size:
+                return page, True
+            page.append((hash_postprocessed, metadata))
+    return page, False
+
+
+def valid_entries(cache, session_id, entries):
+    # Yield the entries, newest first, that are still in the cache. Each output's newest line supersedes its older ones,
+    # and outputs whose audio has been evicted from the cache are skipped. Eviction deletes the audio file, so checking
+    # that the file exists is enough.
+    seen = set()
+    for hash_postprocessed, metadata in entries:
+        if hash_postprocessed not in seen:
+            seen.add(hash_postprocessed)
+            if os.path.isfile(os.path.join(cache.map_folder(Stage.POSTPROCESSED, session_id),
+                                           hash_postprocessed + CACHE_EXTENSION)):
+                yield hash_postprocessed, metadata
+
+
+def read_index_backward(path):
+    # Yield the (hash, metadata) entries of the index from the last line to the first, reading only as much of the file
+    # as the caller consumes. Lines are appended in order of creation, so this yields the newest outputs first. Sorting
+    # isn't needed, but an output whose timestamp was refreshed appears again closer to the end.
+    with open(path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        remainder = b''
+        while position > 0:
+            block_size = min(READ_BLOCK_SIZE, position)
+            position -= block_size
+            file.seek(position)
+            lines = (file.read(block_size) + remainder).split(b'\n')
+            # The first line may continue in the previous block, so keep it for later.
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield parse_line(line)
+        if remainder.strip():
+            yield parse_line(remainder)
+
+
+def parse_line(line):
+    entry = json.loads(line)
+    return entry['Hash'], entry['Metadata']
+
+
+def rewrite_index(path, entries):
+    # entries are (hash, metadata) tuples, newest first. Call this only while holding index_lock(path). The index is
+    # written to a temporary file first so that readers never see a partially written index.
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=INDEX_FILENAME, suffix='.tmp')
+    try:
+        os.fchmod(descriptor, 0o644)  # mkstemp creates the file readable by its owner only.
+        with os.fdopen(descriptor, 'w') as file:
+            for hash_postprocessed, metadata in reversed(entries):
+                file.write(json.dumps({'Hash': hash_postprocessed, 'Metadata': metadata}) + '\n')
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
@@ -0,0 +1,32 @@
+# A GPU job normally runs from start to finish in a single celery task on a GPU worker, so the GPU worker is also kept
+# busy while the input audio is preprocessed and while the output is postprocessed and rendered, all of which is CPU
+# work. With separate pipeline stages, a GPU job is run as a chain of three celery tasks instead:
+#   1. preprocessing, on the PREPROCESS_QUEUE,
+#   2. generating the output on the architecture server, on the architecture's queue, and
+#   3. postprocessing and rendering the output, on the POSTPROCESS_QUEUE,
+# so that GPU workers only ever wait on architecture servers. The preprocess and postprocess queues are served by a
+# separate pool of GPU celery workers started with --serve_pipeline_stages, which don't lease a GPU and can have a much
+# higher concurrency. See job_manager.py.
+#
+# Separate stages must only be enabled if such workers are running, or GPU jobs will never start.
+
+PREPROCESS_QUEUE = 'preprocess'
+POSTPROCESS_QUEUE = 'postprocess'
+STAGE_QUEUES = [PREPROCESS_QUEUE, POSTPROCESS_QUEUE]
+
+_enabled = False
+
+
+def configure(enabled=None):
+    global _enabled
+    _enabled = enabled if enabled is not None else _enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def stage_task_id(job_id, queue):
+    # The ID of the celery task that runs the given stage of a job. The architecture server stage keeps the job's own ID,
+    # so that admission control, fair sharing and cancellation see that stage as the job.
+    return job_id + ':' + queue
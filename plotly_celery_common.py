@@ -1,10 +1,11 @@
-import base64
 import datetime
 import hashlib
+import os
 
 from hay_say_common.cache import Stage
 
 import hay_say_common as hsc
+import sqlite_cache
 from architectures.controllable_talknet.ControllableTalknetTab import ControllableTalknetTab
 from architectures.rvc.RvcTab import RvcTab
 from architectures.so_vits_svc_3.SoVitsSvc3Tab import SoVitsSvc3Tab
@@ -13,6 +14,10 @@ from architectures.so_vits_svc_5.SoVitsSvc5Tab import SoVitsSvc5Tab
 from architectures.styletts_2.StyleTTS2Tab import StyleTTS2Tab
 from architectures.gpt_so_vits.GPTSoVITSTab import GPTSoVITSTab
 
+# Every process that selects a cache implementation imports this module first, including the ones that offer the
+# implementations as command-line choices.
+sqlite_cache.register()
+
 _memoized_architecture_map = None
 
 
@@ -68,9 +73,29 @@ def compute_next_hash(current_hash, *args):
     return hashlib.sha256(base_string.encode('utf-8')).hexdigest()[:20]
 
 
-def prepare_src_attribute(src_bytes, mimetype):
-    binary_contents = b'data:' + mimetype.encode('utf-8') + b',' + base64.b64encode(src_bytes)
-    return binary_contents.decode('utf-8')
+def cache_file_path(cache, stage, session_id, filename_sans_extension):
+    # Return the path to a file in the cache, or None if the cache implementation does not keep its audio in files.
+    if not hasattr(cache, 'map_folder'):
+        return None
+    return os.path.join(cache.map_folder(stage, session_id), filename_sans_extension + hsc.cache.CACHE_EXTENSION)
+
+
+def read_metadata_entry(cache, stage, session_id, filename_sans_extension):
+    # Look up a single entry in the metadata of the given stage. Returns None if there is no such entry.
+    if hasattr(cache, 'read_metadata_entry'):
+        return cache.read_metadata_entry(stage, session_id, filename_sans_extension)
+    return cache.read_metadata(stage, session_id).get(filename_sans_extension)
+
+
+def write_metadata_entry(cache, stage, session_id, filename_sans_extension, entry):
+    # Add or replace a single entry in the metadata of the given stage. Cache implementations that store each entry
+    # separately (e.g. SqliteImpl) update just that entry. Otherwise, the whole metadata dictionary is rewritten.
+    if hasattr(cache, 'write_metadata_entry'):
+        cache.write_metadata_entry(stage, session_id, filename_sans_extension, entry)
+    else:
+        metadata = cache.read_metadata(stage, session_id)
+        metadata[filename_sans_extension] = entry
+        cache.write_metadata(stage, session_id, metadata)
 
 
 def lookup_filehash(cache, selected_file, session_data):
@@ -115,8 +140,7 @@ def preprocess_bytes(bytes_raw, sr_raw, semitone_pitch, debug_pitch, reduce_nois
 
 def write_preprocessed_metadata(cache, hash_raw, hash_preprocessed, semitone_pitch, debug_pitch,
                                 reduce_noise, crop_silence, session_data):
-    preprocessed_metadata = cache.read_metadata(Stage.PREPROCESSED, session_data['id'])
-    preprocessed_metadata[hash_preprocessed] = {
+    write_metadata_entry(cache, Stage.PREPROCESSED, session_data['id'], hash_preprocessed, {
         'Raw File': hash_raw,
         'Options':
             {
@@ -126,5 +150,4 @@ def write_preprocessed_metadata(cache, hash_raw, hash_preprocessed, semitone_pit
                 'Crop Silence': crop_silence
             },
         'Time of Creation': datetime.datetime.now().strftime(hsc.cache.TIMESTAMP_FORMAT)
-    }
-    cache.write_metadata(Stage.PREPROCESSED, session_data['id'], preprocessed_metadata)
+    })
@@ -3,17 +3,29 @@ from numbers import Number
 from dash import html, dcc
 from hay_say_common.cache import Stage
 
-import hay_say_common as hsc
-import plotly_celery_common as pcc
+import output_index
+from audio_streaming import construct_audio_url
 
 CACHE_FORMAT, CACHE_EXTENSION, CACHE_MIMETYPE = 'FLAC', '.flac', 'audio/flac;base64'
+OUTPUT_HISTORY_PAGE_SIZE = 10
 
 
-def prepare_postprocessed_display(cache, hash_postprocessed, session_data, highlight=False):
-    # todo: color-code the information in the display.
-    bytes_postprocessed = cache.read_file_bytes(Stage.POSTPROCESSED, session_data['id'], hash_postprocessed)
+def prepare_output_history_page(cache, session_data, older_than=None, highlight_newest=False):
+    # Render one page of the output history, oldest first. Returns the rendered outputs, the creation time of the oldest
+    # output on the page (pass it back in as older_than to get the next page), and whether there are older outputs.
+    page, has_older_outputs = output_index.read_page(cache, session_data['id'], older_than, OUTPUT_HISTORY_PAGE_SIZE)
+    displays = [prepare_postprocessed_display(cache, hash_postprocessed, session_data, metadata=metadata,
+                                              highlight=highlight_newest and index == 0)
+                for index, (hash_postprocessed, metadata) in reversed(list(enumerate(page)))]
+    oldest_timestamp = page[-1][1]['Time of Creation'] if page else older_than
+    return displays, oldest_timestamp, has_older_outputs
+
 
-    metadata = cache.read_metadata(Stage.POSTPROCESSED, session_data['id'])[hash_postprocessed]
+def prepare_postprocessed_display(cache, hash_postprocessed, session_data, highlight=False, metadata=None):
+    # todo: color-code the information in the display.
+    # Callers that already have the output's metadata entry can pass it in to avoid re-reading the metadata file.
+    if metadata is None:
+        metadata = cache.read_metadata(Stage.POSTPROCESSED, session_data['id'])[hash_postprocessed]
     selected_file = metadata['Inputs']['User File']
     user_text = metadata['Inputs']['User Text']
     if metadata['Preprocessing Options']:
@@ -36,12 +48,13 @@ def prepare_postprocessed_display(cache, hash_postprocessed, session_data, highl
             html.Tr(
                 # This table entry serves the special purpose of alerting screen readers that generation is complete.
                 html.Td('New Output Generated:' if highlight else '', role='status' if highlight else None,
-                        colSpan=3)
+                        colSpan=3, className='new-output-label')
             ),
             html.Tr([
                 html.Td(''),
                 html.Td([
-                    html.Audio(src=pcc.prepare_src_attribute(bytes_postprocessed, hsc.cache.CACHE_MIMETYPE), controls=True),
+                    html.Audio(src=construct_audio_url(Stage.POSTPROCESSED, session_data['id'], hash_postprocessed),
+                               controls=True, preload='metadata'),
                 ]),
                 html.Td(
                     html.Button('Download', id={'type': 'output-download-button', 'index': hash_postprocessed}),
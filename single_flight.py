@@ -0,0 +1,64 @@
+import json
+import time
+import uuid
+
+import redis
+
+import coordination
+
+# If several identical requests arrive while one of them is being generated, only the first one (the "leader") is sent
+# to the architecture server. The others ("followers") wait for the leader to finish and then reuse its output. Jobs
+# call wait before they take an architecture slot or lease a GPU, so that followers don't hold either while they wait.
+
+KEY_PREFIX = 'hay_say:single_flight:'
+LOCK_TIMEOUT = 900  # seconds. A leader that crashes without releasing its lock stops blocking followers after this.
+RESULT_TIMEOUT = 60  # seconds. Followers only need the result for as long as it takes them to notice the lock is gone.
+POLL_INTERVAL = 0.5  # seconds
+
+
+def run(flight_key, leader_function):
+    """Call leader_function and return (its result, True), unless another request with the same flight_key is already
+    in flight, in which case wait for it to finish and return (the other request's result, False) instead. The result
+    must be JSON serializable. If the other request fails, this one takes over and calls leader_function itself."""
+    client = coordination.redis_client()
+    lock_key = KEY_PREFIX + flight_key + ':lock'
+    result_key = KEY_PREFIX + flight_key + ':result'
+    try:
+        while True:
+            token = uuid.uuid4().hex
+            if client.set(lock_key, token, nx=True, ex=LOCK_TIMEOUT):
+                break
+            while client.exists(lock_key):
+                time.sleep(POLL_INTERVAL)
+            result = client.get(result_key)
+            if result is not None:
+                return json.loads(result), False
+            # The leader failed without producing a result. Try to become the leader.
+    except redis.exceptions.ConnectionError:
+        # Coalescing is an optimization. Don't fail the request just because Redis is unavailable.
+        return leader_function(), True
+
+    try:
+        # Clear out the result of any earlier flight so that followers cannot mistake it for the result of this one.
+        client.delete(result_key)
+        result = leader_function()
+        client.set(result_key, json.dumps(result), ex=RESULT_TIMEOUT)
+        return result, True
+    finally:
+        coordination.release_lock(lock_key, token)
+
+
+def wait(flight_key):
+    """If a request with the same flight_key is in flight, wait for it to finish and return its result. Return None if
+    there is no such request, or if it failed. Unlike run, this never makes the caller the leader."""
+    client = coordination.redis_client()
+    lock_key = KEY_PREFIX + flight_key + ':lock'
+    try:
+        if not client.exists(lock_key):
+            return None
+        while client.exists(lock_key):
+            time.sleep(POLL_INTERVAL)
+        result = client.get(KEY_PREFIX + flight_key + ':result')
+    except redis.exceptions.ConnectionError:
+        return None
+    return None if result is None else json.loads(result)
@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+import threading
+
+from hay_say_common.cache import FileImpl, CACHE_EXTENSION
+from hay_say_common.file_integration import guarantee_directory
+
+import hay_say_common as hsc
+
+SQLITE_IMPLEMENTATION_NAME = 'sqlite'
+
+
+class SqliteImpl(FileImpl):
+    """Stores audio files exactly like FileImpl does, but keeps the metadata in a SQLite database with one row per file
+    instead of one JSON file per stage. Adding, updating or looking up an entry touches a single row, so concurrent
+    writers no longer overwrite each other's entries and the cost of a write does not grow with the number of files.
+    """
+    DATABASE_PATH = os.path.join(FileImpl.AUDIO_FOLDER, 'metadata.sqlite3')
+    BUSY_TIMEOUT = 30  # seconds
+
+    _connections = threading.local()
+
+    @classmethod
+    def connection(cls):
+        """Return a connection to the metadata database for the current thread. Connections must not be shared across
+        processes, so a new one is opened if this process was forked after the connection was created (gunicorn and
+        celery both fork their workers)."""
+        if getattr(cls._connections, 'pid', None) != os.getpid():
+            guarantee_directory(os.path.dirname(cls.DATABASE_PATH))
+            connection = sqlite3.connect(cls.DATABASE_PATH, timeout=cls.BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                               'session_id TEXT NOT NULL, '
+                               'stage TEXT NOT NULL, '
+                               'hash TEXT NOT NULL, '
+                               'time_of_creation TEXT NOT NULL, '
+                               'entry TEXT NOT NULL, '
+                               'PRIMARY KEY (session_id, stage, hash))')
+            connection.execute('CREATE INDEX IF NOT EXISTS metadata_by_time_of_creation '
+                               'ON metadata (session_id, stage, time_of_creation)')
+            cls._connections.connection = connection
+            cls._connections.pid = os.getpid()
+        return cls._connections.connection
+
+    @staticmethod
+    def session_key(session_id):
+        # SQLite treats NULLs as distinct from each other in a primary key, so store the shared cache under ''.
+        return session_id or ''
+
+    @classmethod
+    def read_metadata(cls, stage, session_id):
+        """Return the metadata dictionary of the cache at the specified stage. The metadata dictionary describes all the
+        files stored in the cache at a given stage.
+        'stage' should be one of the Stage enums"""
+        rows = cls.connection().execute('SELECT hash, entry FROM metadata WHERE session_id = ? AND stage = ?',
+                                        (cls.session_key(session_id), stage.name)).fetchall()
+        return {filename_sans_extension: json.loads(entry) for filename_sans_extension, entry in rows}
+
+    @classmethod
+    def write_metadata(cls, stage, session_id, dict_contents):
+        """Sets the metadata dictionary to the supplied dictionary for the cache at the specified stage, overwriting
+        existing contents. Prefer write_metadata_entry, which only touches a single entry.
+        'stage' should be one of the Stage enums"""
+        # FileImpl creates the stage's directory as a side effect of writing metadata, and callers rely on that.
+        guarantee_directory(cls.map_folder(stage, session_id))
+        connection = cls.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM metadata WHERE session_id = ? AND stage = ?',
+                               (cls.session_key(session_id), stage.name))
+            connection.executemany('INSERT INTO metadata VALUES (?, ?, ?, ?, ?)',
+                                   [(cls.session_key(session_id), stage.name, filename_sans_extension,
+                                     entry['Time of Creation'], json.dumps(entry, sort_keys=True))
+                                    for filename_sans_extension, entry in dict_contents.items()])
+
+    @classmethod
+    def read_metadata_entry(cls, stage, session_id, filename_sans_extension):
+        """Return the metadata entry of a single file in the cache at the specified stage, or None if there is no such
+        file.
+        'stage' should be one of the Stage enums"""
+        row = cls.connection().execute('SELECT entry FROM metadata WHERE session_id = ? AND stage = ? AND hash = ?',
+                                       (cls.session_key(session_id), stage.name, filename_sans_extension)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @classmethod
+    def write_metadata_entry(cls, stage, session_id, filename_sans_extension, entry):
+        """Adds the metadata entry of a single file to the cache at the specified stage, replacing any existing entry
+        for that file. The entry must have a 'Time of Creation'.
+        'stage' should be one of the Stage enums"""
+        cls.connection().execute('INSERT INTO metadata VALUES (?, ?, ?, ?, ?) '
+                                 'ON CONFLICT (session_id, stage, hash) DO UPDATE SET '
+                                 'time_of_creation = excluded.time_of_creation, entry = excluded.entry',
+                                 (cls.session_key(session_id), stage.name, filename_sans_extension,
+                                  entry['Time of Creation'], json.dumps(entry, sort_keys=True)))
+
+    @classmethod
+    def read_metadata_page(cls, stage, session_id, older_than=None, page_size=10):
+        """Return a list of up to page_size (hash, metadata entry) tuples for the newest files created before older_than
+        in the cache at the specified stage, sorted from newest to oldest, and a boolean indicating whether there are
+        even older files. older_than is a timestamp string in TIMESTAMP_FORMAT, or None to start from the newest file.
+        'stage' should be one of the Stage enums"""
+        query = 'SELECT hash, entry FROM metadata WHERE session_id = ? AND stage = ?'
+        parameters = (cls.session_key(session_id), stage.name)
+        if older_than is not None:
+            query, parameters = query + ' AND time_of_creation < ?', parameters + (older_than,)
+        rows = cls.connection().execute(query + ' ORDER BY time_of_creation DESC LIMIT ?',
+                                        parameters + (page_size + 1,)).fetchall()
+        page = [(filename_sans_extension, json.loads(entry)) for filename_sans_extension, entry in rows]
+        return page[:page_size], len(page) > page_size
+
+    @classmethod
+    def count_audio_cache_files(cls, stage, session_id):
+        """Return the number of audio files stored in the cache at the specified stage.
+        'stage' should be one of the Stage enums"""
+        return cls.connection().execute('SELECT COUNT(*) FROM metadata WHERE session_id = ? AND stage = ?',
+                                        (cls.session_key(session_id), stage.name)).fetchone()[0]
+
+    @classmethod
+    def delete_oldest_cache_file(cls, stage, session_id):
+        """Deletes the oldest file from the cache at the specified stage.
+        'stage' should be one of the Stage enums"""
+        row = cls.connection().execute('SELECT hash FROM metadata WHERE session_id = ? AND stage = ? '
+                                       'ORDER BY time_of_creation ASC LIMIT 1',
+                                       (cls.session_key(session_id), stage.name)).fetchone()
+        if row is None:
+            return
+        oldest_filename_sans_extension = row[0]
+        oldest_path = os.path.join(cls.map_folder(stage, session_id), oldest_filename_sans_extension + CACHE_EXTENSION)
+        if os.path.isfile(oldest_path):
+            os.remove(oldest_path)
+        cls.connection().execute('DELETE FROM metadata WHERE session_id = ? AND stage = ? AND hash = ?',
+                                 (cls.session_key(session_id), stage.name, oldest_filename_sans_extension))
+
+    @classmethod
+    def get_hashes_sorted_by_timestamp(cls, stage, session_id):
+        """Returns the hashes/filenames (without extension) of the audio files in the cache at the specified stage, sorted
+        by their timestamp, newest first.
+        'stage' should be one of the Stage enums"""
+        rows = cls.connection().execute('SELECT hash FROM metadata WHERE session_id = ? AND stage = ? '
+                                        'ORDER BY time_of_creation DESC',
+                                        (cls.session_key(session_id), stage.name)).fetchall()
+        return [row[0] for row in rows]
+
+    @classmethod
+    def file_is_already_cached(cls, stage, session_id, filename_sans_extension):
+        """Return True if the specified file is already present in the cache at the specified stage, otherwise False
+        'stage' should be one of the Stage enums"""
+        return cls.read_metadata_entry(stage, session_id, filename_sans_extension) is not None
+
+    @classmethod
+    def delete_all_files_at_stage(cls, stage, session_id):
+        """Deletes all files and all metadata at the specified stage
+        'stage' should be one of the Stage enums"""
+        super().delete_all_files_at_stage(stage, session_id)
+        cls.connection().execute('DELETE FROM metadata WHERE session_id = ? AND stage = ?',
+                                 (cls.session_key(session_id), stage.name))
+
+    @classmethod
+    def delete_session_data(cls, session_id):
+        """Deletes all data associated with the given session ID"""
+        super().delete_session_data(session_id)
+        cls.connection().execute('DELETE FROM metadata WHERE session_id = ?', (cls.session_key(session_id),))
+
+
+def register():
+    # Register the implementation so that it can be selected with --cache_implementation sqlite, just like the
+    # implementations that ship with hay_say_common.
+    hsc.cache.cache_implementation_map[SQLITE_IMPLEMENTATION_NAME] = SqliteImpl
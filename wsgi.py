@@ -1,6 +1,8 @@
 import sys
 
 import plotly_celery_common as pcc
+from admission import DEFAULT_MAX_QUEUED_JOBS
+from fair_share import DEFAULT_MAX_JOBS_PER_SESSION, DEFAULT_TRUSTED_PROXIES
 from main import build_app, parse_arguments
 from server_initialization import initialize_app
 
@@ -14,11 +16,14 @@ from server_initialization import initialize_app
 # gunicorn --workers 1 --bind 0.0.0.0:6573 'wsgi:get_server(enable_model_management=True)'
 # See the parse_arguments method.
 def get_server(update_model_lists_on_startup=False, enable_model_management=False, enable_session_caches=False,
-               cache_implementation='file', migrate_models=False, architectures=None):
+               cache_implementation='file', migrate_models=False, architectures=None,
+               max_jobs_per_session=DEFAULT_MAX_JOBS_PER_SESSION, max_queued_jobs=DEFAULT_MAX_QUEUED_JOBS,
+               separate_pipeline_stages=False, trusted_proxies=DEFAULT_TRUSTED_PROXIES):
     if architectures is None:
         architectures = []
     app = build_app(architectures, update_model_lists_on_startup, enable_model_management, enable_session_caches,
-                    cache_implementation, migrate_models)
+                    cache_implementation, migrate_models, max_jobs_per_session, max_queued_jobs,
+                    separate_pipeline_stages, trusted_proxies)
     return app.server
 
 
@@ -32,5 +37,6 @@ if __name__ == '__main__':
     args = parse_arguments(sys.argv[1:])
     initialize_app(args.architectures, args.migrate_models, args.update_model_lists_on_startup)
     app = build_app(args.architectures, args.update_model_lists_on_startup, args.enable_model_management, args.enable_session_caches,
-                    args.cache_implementation, args.migrate_models)
+                    args.cache_implementation, args.migrate_models, args.max_jobs_per_session,
+                    args.max_queued_jobs, args.separate_pipeline_stages, args.trusted_proxies)
     app.run(host='0.0.0.0', port=6573, debug=True)